@@ -6,11 +6,14 @@ import numpy as np
 import pandas as pd
 import yaml
 
-from hana.function import timeseries_to_surrogates, all_timelag_standardscore, all_peaks
-from hana.polychronous import shuffle_network, filter, extract_pcgs
-from hana.recording import load_traces, load_timeseries, partial_timeseries
+from hana.function import timeseries_to_surrogates, all_timelag_standardscore, all_peaks, SurrogateTimeseries, \
+    candidate_pairs, adaptive_timelag_standardscore, IncrementalStandardScore
+from hana.polychronous import shuffle_network, filter, extract_pcgs, extract_pcg_sizes, stream_pcgs, \
+    PolychronousGroupsFile, load_pcgs, pcg_size_statistics, surrogate_pcg_ensemble
+from hana.recording import load_traces, load_timeseries, partial_interval, EventsFile
 from hana.segmentation import extract_and_save_compartments, load_neurites, load_compartments
 from hana.structure import all_overlaps
+from hana.timelags import TimelagStore
 
 
 class Experiment:
@@ -89,37 +92,43 @@ class Experiment:
         triggers, AIS, delays, positive_peak = load_compartments(self.neurites_filename)
         return triggers, AIS, delays, positive_peak
 
-    def timeseries(self):
+    def timeseries(self, sampling_rate=None):
         """
         Load time series for all neurons, and return only those with axons.
+        :param sampling_rate: (optional) keep spike times as sample indices, see recording.load_timeseries
         :return: time series indexed by neurons
         """
         events_filename = os.path.join(self.data_directory, 'events.h5')
         axon_delay, dendrite_peak = self.neurites()
         neurons_with_axons = axon_delay.keys()
         logging.info('Neurons with axon: {}'.format(neurons_with_axons))
-        return load_timeseries(events_filename, neurons=neurons_with_axons)
+        return load_timeseries(events_filename, neurons=neurons_with_axons, sampling_rate=sampling_rate)
+
+    def events(self):
+        """
+        Streaming access to the time series of neurons with axons, for recordings larger than memory.
+        :return: recording.EventsFile (to be closed, e.g. by using it in a with statement)
+        """
+        events_filename = os.path.join(self.data_directory, 'events.h5')
+        axon_delay, dendrite_peak = self.neurites()
+        return EventsFile(events_filename, neurons=axon_delay.keys())
 
 
 class NetworkExperiment(Experiment):
 
-    def timeseries_surrogates(self):
+    def timeseries_surrogates(self, n=10, factor=2, seed=0):
         """
-        Calculate surrogates for original time series.
-        :return: dictionary indexed by neurons
+        Surrogates for original time series. They are generated on demand from seeded random streams, therefore they
+        are neither kept in memory nor stored.
+        :param n, factor, seed: see function.SurrogateTimeseries
+        :return: dictionary-like SurrogateTimeseries indexed by neurons
         """
-        timesseries_surrogates_filename = os.path.join(self.results_directory, 'events_surrogates.p')
-        if not os.path.isfile(timesseries_surrogates_filename):
-            logging.info('Surrogate time series')
-            timeseries_surrogates = timeseries_to_surrogates(self.timeseries())
-            pickle.dump(timeseries_surrogates, open(timesseries_surrogates_filename, 'wb'))
-        else:
-            timeseries_surrogates = pickle.load(open(timesseries_surrogates_filename, 'rb'))
-        return timeseries_surrogates
+        return SurrogateTimeseries(self.timeseries(), n=n, factor=factor, seed=seed)
 
-    def standardscores(self):
+    def standardscores(self, workers=1):
         """
         Extract standard score for spike timings.
+        :param workers: number of worker processes (None: all cores)
         :return:
         timelags: time lags used for computation of histograms
         std_score_dict: standard scores indexed by pairs of pre and post-synaptic neurons:
@@ -128,8 +137,85 @@ class NetworkExperiment(Experiment):
         standardscores_filename = os.path.join(self.results_directory, 'standardscores.p')
         if not os.path.isfile(standardscores_filename):
             logging.info('Compute standard score for histograms')
-            timelags, std_score_dict, timeseries_hist_dict = all_timelag_standardscore(self.timeseries(),
-                                                                                       self.timeseries_surrogates())
+            timelags, std_score_dict, timeseries_hist_dict = all_timelag_standardscore(
+                self.timeseries(), self.timeseries_surrogates(), workers=workers)
+            pickle.dump((timelags, std_score_dict, timeseries_hist_dict), open(standardscores_filename, 'wb'))
+        else:
+            timelags, std_score_dict, timeseries_hist_dict = pickle.load(open(standardscores_filename, 'rb'))
+        return timelags, std_score_dict, timeseries_hist_dict
+
+    def structural_standardscores(self, workers=1, min_spike_count=0):
+        """
+        Extract standard score for spike timings, but only for structurally connected pairs of neurons (see
+        structural_network). These are cached separately from the standard scores for all pairs.
+        :param workers: number of worker processes (None: all cores)
+        :param min_spike_count: (optional) minimum number of spikes of pre and post-synaptic neuron
+        :return: see standardscores
+        """
+        standardscores_filename = os.path.join(self.results_directory, 'standardscores_structural.p')
+        if not os.path.isfile(standardscores_filename):
+            logging.info('Compute standard score for histograms of structurally connected pairs')
+            timeseries = self.timeseries()
+            structural_delay, _ = self.structural_network()
+            pairs = candidate_pairs(timeseries, structural_delay, min_spike_count=min_spike_count)
+            timelags, std_score_dict, timeseries_hist_dict = all_timelag_standardscore(
+                timeseries, self.timeseries_surrogates(), workers=workers, pairs=pairs)
+            pickle.dump((timelags, std_score_dict, timeseries_hist_dict), open(standardscores_filename, 'wb'))
+        else:
+            timelags, std_score_dict, timeseries_hist_dict = pickle.load(open(standardscores_filename, 'rb'))
+        return timelags, std_score_dict, timeseries_hist_dict
+
+    def adaptive_standardscores(self, n_max=100):
+        """
+        Extract standard score for spike timings with explicit surrogates, but only as many (up to n_max) as needed to
+        decide whether a pair is significant, see function.adaptive_timelag_standardscore_array.
+        :param n_max: maximal number of surrogates for each pair
+        :return: see standardscores, and
+        n_used_dict: number of surrogates indexed by pairs of pre and post-synaptic neurons
+        """
+        standardscores_filename = os.path.join(self.results_directory, 'standardscores_adaptive.p')
+        if not os.path.isfile(standardscores_filename):
+            logging.info('Compute standard score for histograms with adaptive number of surrogates')
+            timelags, std_score_dict, timeseries_hist_dict, n_used_dict = adaptive_timelag_standardscore(
+                self.timeseries(), self.timeseries_surrogates(n=n_max))
+            pickle.dump((timelags, std_score_dict, timeseries_hist_dict, n_used_dict),
+                        open(standardscores_filename, 'wb'))
+        else:
+            timelags, std_score_dict, timeseries_hist_dict, n_used_dict = pickle.load(
+                open(standardscores_filename, 'rb'))
+        return timelags, std_score_dict, timeseries_hist_dict, n_used_dict
+
+    def timelag_store(self, max_timelag=0.005):
+        """
+        Raw time lags for all pairs and their surrogates, for recomputing standard scores for other bins.
+        :param max_timelag: maximal absolute time lag (in s)
+        :return: TimelagStore, e.g. timelag_store().standardscores(min_timelag=-0.003, max_timelag=0.003, bin_n=30)
+        """
+        timelags_filename = os.path.join(self.results_directory, 'timelags.h5')
+        if not os.path.isfile(timelags_filename):
+            logging.info('Collect time lags within +/-%g s' % max_timelag)
+            store = TimelagStore.from_timeseries(self.timeseries(), self.timeseries_surrogates(),
+                                                 max_timelag=max_timelag)
+            store.save(timelags_filename)
+        else:
+            store = TimelagStore.load(timelags_filename)
+        return store
+
+    def incremental_standardscores(self, chunk_duration=600.0):
+        """
+        Extract standard score for spike timings (with surrogates) by reading the recording chunk by chunk, so that the
+        spike times are never loaded at once, see function.IncrementalStandardScore.
+        :param chunk_duration: duration of each chunk in s
+        :return: see standardscores
+        """
+        standardscores_filename = os.path.join(self.results_directory, 'standardscores_incremental.p')
+        if not os.path.isfile(standardscores_filename):
+            logging.info('Compute standard score for histograms from chunks of %g s' % chunk_duration)
+            with self.events() as events:
+                accumulator = IncrementalStandardScore(list(events))
+                for begin, end, chunk in events.chunks(chunk_duration):
+                    accumulator.add(chunk, end=end)
+            timelags, std_score_dict, timeseries_hist_dict = accumulator.standardscores()
             pickle.dump((timelags, std_score_dict, timeseries_hist_dict), open(standardscores_filename, 'wb'))
         else:
             timelags, std_score_dict, timeseries_hist_dict = pickle.load(open(standardscores_filename, 'rb'))
@@ -168,9 +254,17 @@ class NetworkExperiment(Experiment):
                functional_strength, functional_delay,  \
                synaptic_strength, synaptic_delay
 
-    def synaptic_network(self):
-        # synaptic networks: use axonal delays from structural connectivity and a minimal synapstic delays of 1.0 ms
-        timelags, std_score_dict, timeseries_hist_dict = self.standardscores()
+    def synaptic_network(self, structural_only=False):
+        """
+        Synaptic network, using axonal delays from structural connectivity and a minimal synaptic delay of 1.0 ms.
+        :param structural_only: compute the standard scores only for structurally connected pairs (see
+        structural_standardscores), unless those for all pairs are cached anyway; use this if the functional network
+        is not needed
+        """
+        if structural_only and not os.path.isfile(os.path.join(self.results_directory, 'standardscores.p')):
+            timelags, std_score_dict, timeseries_hist_dict = self.structural_standardscores()
+        else:
+            timelags, std_score_dict, timeseries_hist_dict = self.standardscores()
         structural_delay, structural_strength = self.structural_network()
         synaptic_strength, synaptic_delay, _ = all_peaks(timelags, std_score_dict,
                                                          structural_delay_dict=structural_delay,
@@ -217,24 +311,27 @@ class PatternExperiment(NetworkExperiment):
     def partial_timeseries(self, interval=0.1):
         """
         Extract partial timeseries for extraction of polychronous groups. This takes a lot of time, therefore not
-        all data is used by default.
-        :param interval: part of time series (default: 0.1, first 10% of the data are used)
+        all data is used by default. Only the time window is cached, and only the spikes within it are read from
+        the recording.
+        :param interval: part of time series (default: 0.1, first 10% of the data are used), or (begin, end) in s
         :return: time series dictionary indexed by neurons
         """
-        partial_timeseries_pickle_name = os.path.join(self.results_directory, 'partial_timeseries.p')
-        if not os.path.isfile(partial_timeseries_pickle_name):
-            timeseries = self.timeseries()
-            timeseries = partial_timeseries(timeseries, interval=interval)
-            pickle.dump(timeseries, open(partial_timeseries_pickle_name, 'wb'))
-        else:
-            timeseries = pickle.load(open(partial_timeseries_pickle_name, 'rb'))
-        return timeseries
-
-    def connected_events(self, surrogate=None):
+        partial_interval_pickle_name = os.path.join(self.results_directory, 'partial_interval.p')
+        with self.events() as events:
+            if not os.path.isfile(partial_interval_pickle_name):
+                interval = partial_interval(events, interval=interval)
+                pickle.dump(interval, open(partial_interval_pickle_name, 'wb'))
+            else:
+                interval = pickle.load(open(partial_interval_pickle_name, 'rb'))
+            logging.info('Partial timeseries spanning %d~%d [s]' % interval)
+            return events.timeseries(*interval)
+
+    def connected_events(self, surrogate=None, workers=1):
         """
         Extract connected events
         :param surrogate: None: original data
                           1, 2, or 3: surrogates 1, 2, or 3
+        :param workers: number of worker processes for polychronous.filter
         :return:
         """
         suffix = '_surrogate_%d' % surrogate if surrogate else ''
@@ -250,7 +347,7 @@ class PatternExperiment(NetworkExperiment):
                 # keeping only the first of several surrogate times series for each neuron
                 timeseries = {neuron: timeseries[0] for neuron, timeseries in surrogate_timeseries.items()}
             connected_events = filter(timeseries, putative_delays, additional_synaptic_delay=0,
-                                      synaptic_jitter=0.0005)
+                                      synaptic_jitter=0.0005, workers=workers)
             pickle.dump(connected_events, open(connected_events_pickle_name, 'wb'))
         else:
             connected_events = pickle.load(open(connected_events_pickle_name, 'rb'))
@@ -270,6 +367,20 @@ class PatternExperiment(NetworkExperiment):
             pcgs, pcgs_size = pickle.load(open(PCG_pickle_name, 'rb'))
         return pcgs, pcgs_size
 
+    def streamed_polychronous_groups(self, chunk_duration=10.0):
+        """
+        Extract polychronous groups of the whole recording by streaming it from the events file, see
+        polychronous.stream_pcgs. The groups are stored in pcgs.h5, see polychronous.PolychronousGroupsFile.
+        :param chunk_duration: duration (in s) of each sweep step
+        :return: connected_events, offsets, sizes: see polychronous.load_pcgs
+        """
+        pcgs_filename = os.path.join(self.results_directory, 'pcgs.h5')
+        if not os.path.isfile(pcgs_filename):
+            with self.events() as events, PolychronousGroupsFile(pcgs_filename) as pcgs_file:
+                stream_pcgs(events, self.putative_delays(), pcgs_file, additional_synaptic_delay=0,
+                            synaptic_jitter=0.0005, chunk_duration=chunk_duration)
+        return load_pcgs(pcgs_filename)
+
     def polychronous_group_sizes_with_surrogates (self):
         """
         Extract sizes for the polychronous groups for the original data and surrogates
@@ -279,14 +390,34 @@ class PatternExperiment(NetworkExperiment):
         PCG_sizes_pickle_name = os.path.join(self.results_directory, 'pcg_sizes.p')
         if not os.path.isfile(PCG_sizes_pickle_name):
             pcgs, pcgs_size = self.polychronous_groups()
-            _, pcgs1_size = extract_pcgs(self.connected_events(surrogate=1))
-            _, pcgs2_size = extract_pcgs(self.connected_events(surrogate=2))
-            _, pcgs3_size = extract_pcgs(self.connected_events(surrogate=3))
+            pcgs1_size = extract_pcg_sizes(self.connected_events(surrogate=1))
+            pcgs2_size = extract_pcg_sizes(self.connected_events(surrogate=2))
+            pcgs3_size = extract_pcg_sizes(self.connected_events(surrogate=3))
             pickle.dump((pcgs_size, pcgs1_size, pcgs2_size, pcgs3_size), open(PCG_sizes_pickle_name, 'wb'))
         else:
             pcgs_size, pcgs1_size, pcgs2_size, pcgs3_size = pickle.load(open(PCG_sizes_pickle_name, 'rb'))
         return pcgs_size, pcgs1_size, pcgs2_size, pcgs3_size
 
+    def polychronous_group_size_ensemble(self, n=10, seed=0, workers=1):
+        """
+        Distribution of polychronous group sizes for n seeded replicates of each surrogate type (1, 2 and 3 as in
+        connected_events), see polychronous.surrogate_pcg_ensemble. Only the summary statistics are stored.
+        :param n: number of replicates for each surrogate type
+        :param seed: seed for all random streams
+        :param workers: number of worker processes (None: all cores)
+        :return: pcgs_statistics: summary statistics for the original data, see polychronous.pcg_size_statistics
+                 ensemble: for each surrogate type, histograms of group sizes with mean and confidence band
+        """
+        ensemble_pickle_name = os.path.join(self.results_directory, 'pcg_size_ensemble_%d_seed_%d.p' % (n, seed))
+        if not os.path.isfile(ensemble_pickle_name):
+            pcgs_statistics = pcg_size_statistics(extract_pcg_sizes(self.connected_events(workers=workers)))
+            ensemble = surrogate_pcg_ensemble(self.partial_timeseries(), self.putative_delays(), n=n, seed=seed,
+                                              workers=workers)
+            pickle.dump((pcgs_statistics, ensemble), open(ensemble_pickle_name, 'wb'))
+        else:
+            pcgs_statistics, ensemble = pickle.load(open(ensemble_pickle_name, 'rb'))
+        return pcgs_statistics, ensemble
+
 
 def correlate_two_dicts(xdict, ydict, subset_keys=None):
     """Find values with the same key in both dictionary and return two arrays of corresponding values"""
@@ -3,9 +3,12 @@ from itertools import product, groupby
 import numpy as np
 import logging
 
-from scipy.special._ufuncs import erfc
+from scipy.special._ufuncs import erfc, erfcinv
 from statsmodels.stats.multitest import fdrcorrection
 
+from hana.parallel import SharedArrays, shared_arrays, shards, shard_n_for, map_shards
+from hana.spiketrains import SpikeTrains, as_spiketrains, to_ticks
+
 logging.basicConfig(level=logging.DEBUG)
 
 
@@ -29,15 +32,54 @@ def sawtooth(timeseries, dtype = np.float32):
     return [x, y]
 
 
+class TargetIndex(object):
+    """
+    Prepared (target) time series holding the sorted times and the sawtooth functions for the succeeding and
+    preceding time lags. The sawtooth functions (about 8 times the size of the time series) are only built when
+    first used by timelag_by_sawtooth, and then reused for the time lags from the events of every other time series.
+    The searchsorted kernels only use the times.
+    """
+
+    def __init__(self, timeseries):
+        self.times = np.asarray(timeseries)
+        self._succeeding = None
+        self._preceding = None
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def succeeding(self):
+        if self._succeeding is None: self._succeeding = sawtooth(self.times)
+        return self._succeeding
+
+    @property
+    def preceding(self):
+        if self._preceding is None: self._preceding = sawtooth(-self.times[::-1])
+        return self._preceding
+
+
+def target_index(timeseries):
+    """Returns the time series as TargetIndex, unless it is one already."""
+    return timeseries if isinstance(timeseries, TargetIndex) else TargetIndex(timeseries)
+
+
+def target_times(timeseries):
+    """Returns the times of a time series or of a TargetIndex."""
+    return timeseries.times if isinstance(timeseries, TargetIndex) else timeseries
+
+
 def timelag_by_sawtooth (timeseries1, timeseries2):
     """Returns for each event in the first time series the time lags for the event in the second time series
-    that precedes, succeeds. Both time series must be sorted in increasing values. Faster than timelag_by_for_loop."""
+    that precedes, succeeds. Both time series must be sorted in increasing values. Faster than timelag_by_for_loop.
+    The second time series could be a TargetIndex, which avoids rebuilding the sawtooth functions."""
+    target = target_index(timeseries2)
     try:
-        preceding_time_lags = - np.interp(np.flipud(-timeseries1), *sawtooth(-np.flipud(timeseries2)), left=np.nan, right=np.nan)
+        preceding_time_lags = - np.interp(np.flipud(-timeseries1), *target.preceding, left=np.nan, right=np.nan)
     except ValueError:
         preceding_time_lags = []
     try:
-        succeeding_time_lags = np.interp(timeseries1, *sawtooth(timeseries2), left=np.nan, right=np.nan)
+        succeeding_time_lags = np.interp(timeseries1, *target.succeeding, left=np.nan, right=np.nan)
     except ValueError:
         succeeding_time_lags = []
     time_lags =  np.sort(np.hstack([preceding_time_lags, succeeding_time_lags]))
@@ -45,14 +87,92 @@ def timelag_by_sawtooth (timeseries1, timeseries2):
     return np.ma.compressed(valid_time_lags)
 
 
-timelag = timelag_by_sawtooth
+def timelag_by_searchsorted (timeseries1, timeseries2, sort=True):
+    """Returns for each event in the first time series the exact time lags for the event in the second time series
+    that precedes, succeeds. Both time series must be sorted in increasing values. Uses one binary search for each
+    direction and is faster than timelag_by_sawtooth. The second time series could be a TargetIndex.
+    If sort is False, the preceding time lags are followed by the succeeding time lags, which is sufficient for
+    histograms."""
+    timeseries2 = target_times(timeseries2)
+    if len(timeseries2) == 0:
+        return np.zeros(0)
+    # only events after the first (before the last) event in the second time series have a preceding (succeeding) one
+    first = np.searchsorted(timeseries1, timeseries2[0], side='right')
+    last = np.searchsorted(timeseries1, timeseries2[-1], side='left')
+    preceding_time_lags = timeseries2[np.searchsorted(timeseries2, timeseries1[first:], side='left') - 1] \
+                          - timeseries1[first:]
+    succeeding_time_lags = timeseries2[np.searchsorted(timeseries2, timeseries1[:last], side='right')] \
+                           - timeseries1[:last]
+    time_lags = np.hstack((preceding_time_lags, succeeding_time_lags))
+    return np.sort(time_lags) if sort else time_lags
+
+
+timelag = timelag_by_searchsorted
+
+
+def nearest_timelags (timeseries1, timeseries2):
+    """Returns the time lags from each event in the first time series to the events in the second time series that
+    precede and succeed it, together with the index of the event in the first time series each time lag belongs to.
+    Only the second time series must be sorted, therefore the first one could be several time series concatenated.
+    The second time series could be a TargetIndex."""
+    timeseries2 = target_times(timeseries2)
+    preceding = np.searchsorted(timeseries2, timeseries1, side='left') - 1
+    succeeding = np.searchsorted(timeseries2, timeseries1, side='right')
+    has_preceding = np.flatnonzero(preceding >= 0)
+    has_succeeding = np.flatnonzero(succeeding < len(timeseries2))
+    index = np.hstack((has_preceding, has_succeeding))
+    time_lags = np.hstack((timeseries2[preceding[has_preceding]], timeseries2[succeeding[has_succeeding]])) \
+                - timeseries1[index]
+    return time_lags, index
+
 
+def timelag_bins (min_timelag=-0.005, max_timelag=0.005, bin_n=100):
+    """Bin edges for the time lag histograms."""
+    return np.linspace(min_timelag, max_timelag, bin_n + 1, endpoint=True)
 
-def timelag_hist (timelags, min_timelag=-0.005, max_timelag=0.005, bin_n=100):
-    bins = np.linspace(min_timelag, max_timelag, bin_n + 1, endpoint=True)
+
+def timelag_hist (timelags, min_timelag=-0.005, max_timelag=0.005, bin_n=100, sampling_rate=None):
+    """Count histogram of the time lags, which are sample indices if a sampling rate is given, see timelag_bin_index.
+    :return: counts, bins: bin edges in s"""
+    bins = timelag_bins(min_timelag, max_timelag, bin_n)
+    if sampling_rate is not None:
+        return labeled_timelag_hist(timelags, np.zeros(len(timelags), dtype=np.int64), 1, bins, sampling_rate)[0], bins
     return np.histogram(timelags, bins=bins)
 
 
+def timelag_bin_index (timelags, bins, sampling_rate=None):
+    """Returns the bin for each time lag, or -1 if outside the bins. Same as np.histogram, all but the last bin are
+    half open, e.g. [-5, -4.9), and the last bin is closed, e.g. [4.9, 5]. If a sampling rate is given, the time lags
+    are (integer) sample indices, and if the bin edges (in s) fall on whole samples, the bins are computed by integer
+    division, which is exact."""
+    if sampling_rate is not None:
+        edges = bins * sampling_rate
+        first, width = int(np.round(edges[0])), int(np.round(edges[1] - edges[0]))
+        last = len(bins) - 2
+        if width > 0 and np.allclose(edges, first + width * np.arange(len(bins)), rtol=0, atol=1e-6):
+            timelags = np.asarray(timelags, dtype=np.int64)
+            index = (timelags - first) // width
+            index[timelags == first + width * (last + 1)] = last
+            index[(index < 0) | (index > last)] = -1
+            return index
+        bins = edges  # exact comparison of the sample indices with the edges in samples
+    index = np.searchsorted(bins, timelags, side='right') - 1
+    index[timelags == bins[-1]] = len(bins) - 2
+    index[index >= len(bins) - 1] = -1
+    return index
+
+
+def labeled_timelag_hist (timelags, labels, label_n, bins, sampling_rate=None):
+    """Histograms of time lags, one for each label, at once using np.bincount. The time lags are sample indices if a
+    sampling rate is given, see timelag_bin_index.
+    :return: counts: array indexed by (label, bin)"""
+    bin_n = len(bins) - 1
+    index = timelag_bin_index(timelags, bins, sampling_rate)
+    valid = index >= 0
+    counts = np.bincount(labels[valid] * bin_n + index[valid], minlength=label_n * bin_n)
+    return counts.reshape(label_n, bin_n)
+
+
 def swap_intervals (timeseries, indicies):
     """Swap intervals between adjacent intervals indicated by indicies"""
     intervals = np.diff(timeseries)
@@ -61,20 +181,20 @@ def swap_intervals (timeseries, indicies):
     return np.hstack([timeseries[0], timeseries[0]+np.cumsum(intervals)])
 
 
-def randomize_intervals_by_swapping (timeseries, factor):
+def randomize_intervals_by_swapping (timeseries, factor, random_state=np.random):
     """Randomize timeseries by randomly swapping adjacent intervals, total factor times the length of timeseries"""
     length = len(timeseries)-1
     times = round(factor*length,0)
-    indicies = np.random.randint(0,length-1,int(times))
+    indicies = random_state.randint(0,length-1,int(times))
     return swap_intervals(timeseries,indicies)
 
 
-def randomize_intervals_by_gaussian (timeseries, factor):
+def randomize_intervals_by_gaussian (timeseries, factor, random_state=np.random):
     """Randomize timeseries by assuming indicies make a random walk with (+factor,-factor) of equal probability.
     Much faster than randomize_intervals_by_swapping."""
     gaps = np.diff(timeseries)
     length = len(gaps)
-    new_positions = range(length) + np.random.normal(0, factor, length)
+    new_positions = range(length) + random_state.normal(0, factor, length)
     index = np.argsort(new_positions)
     return timeseries[0] + np.hstack((0,np.cumsum(gaps[index])))
 
@@ -82,16 +202,51 @@ def randomize_intervals_by_gaussian (timeseries, factor):
 randomize_intervals = randomize_intervals_by_gaussian
 
 
-def surrogate_timeseries (timeseries, n=10, factor=2):
-    return [randomize_intervals(timeseries,factor=factor) for i in range(n)]
+def randomize_intervals_batch (timeseries, n, factor, random_state=np.random):
+    """Returns n surrogates of randomize_intervals_by_gaussian at once as array indexed by (surrogate, event), using a
+    single draw of the noise, a row-wise argsort and a row-wise cumsum. The result is the same as n consecutive calls
+    of randomize_intervals_by_gaussian with the same random state."""
+    gaps = np.diff(timeseries)
+    length = len(gaps)
+    new_positions = random_state.normal(0, factor, (n, length))
+    new_positions += np.arange(length)
+    index = np.argsort(new_positions, axis=1)
+    del new_positions
+    surrogates = np.zeros((n, length + 1))
+    np.take(gaps, index, out=surrogates[:, 1:])
+    del index
+    np.cumsum(surrogates, axis=1, out=surrogates)
+    surrogates += timeseries[0]
+    return surrogates
+
+
+def surrogate_timeseries (timeseries, n=10, factor=2, random_state=np.random):
+    return list(randomize_intervals_batch(timeseries, n, factor, random_state=random_state))
 
 
-def timelag_standardscore(timeseries1, timeseries2, surrogates):
+def surrogates_timelag_hist (timeseries1, surrogates, bins):
+    """Histograms of the time lags from the first time series to each surrogate time series at once.
+    :param surrogates: array indexed by (surrogate, event), see randomize_intervals_batch, or list of time series
+    :return: counts: array indexed by (surrogate, bin)"""
+    time_lags = [timelag(timeseries1, surrogate, sort=False) for surrogate in surrogates]
+    labels = np.repeat(np.arange(len(time_lags)), [len(t) for t in time_lags])
+    time_lags = np.hstack(time_lags) if len(time_lags) > 0 else np.zeros(0)
+    return labeled_timelag_hist(time_lags, labels, len(surrogates), bins)
+
+
+def timelag_standardscore(timeseries1, timeseries2, surrogates, backend='event'):
     """Returns timelags (midpoints of bins) and standard score as well as the counts from the orginal timeseries
-    and mean and standard deviation for the counts from surrogate timeseries"""
-    timeseries_hist, bins = timelag_hist(timelag(timeseries1, timeseries2))
+    and mean and standard deviation for the counts from surrogate timeseries. The surrogates could be an array, see
+    randomize_intervals_batch. With backend='fft' the counts are binned cross-correlograms, which count
+    all time lags within the bins and not only those to the nearest events, see binned_timelag_hists."""
+    if backend == 'fft':
+        hist, bins = binned_timelag_hists([timeseries1], [target_times(timeseries2)] +
+                                          [target_times(surrogate) for surrogate in surrogates])
+        timeseries_hist, surrogates_hist = hist[0, 0], hist[0, 1:]
+    else:
+        timeseries_hist, bins = timelag_hist(timelag(timeseries1, timeseries2, sort=False))
+        surrogates_hist = surrogates_timelag_hist(timeseries1, surrogates, bins)
     timelags = (bins[:-1] + bins[1:])/2 * 1000  # ms
-    surrogates_hist = np.vstack([timelag_hist(timelag(timeseries1, surrogate))[0] for surrogate in surrogates])
     surrogates_mean = surrogates_hist.mean(0)
     surrogates_std = np.std(surrogates_hist, 0)
     try: std_score = (timeseries_hist - surrogates_mean) / surrogates_std
@@ -99,33 +254,927 @@ def timelag_standardscore(timeseries1, timeseries2, surrogates):
     return timelags, std_score, timeseries_hist, surrogates_mean, surrogates_std
 
 
-def timeseries_to_surrogates(timeseries, n=10, factor=2):
-    """Generating surrogate timeseries (this can take a while)"""
-    timeseries_surrogates = dict([(key, surrogate_timeseries(timeseries[key], n=n, factor=factor)) for key in timeseries])
-    return timeseries_surrogates
+def surrogate_random_state(seed, neuron, k):
+    """Independent random stream for the k-th surrogate of a neuron. For a fixed seed, each surrogate is the same,
+    independent of the order in which (or the process by which) the surrogates are generated."""
+    return np.random.default_rng([seed, neuron, k])
+
+
+class SurrogateTimeseries(object):
+    """
+    Surrogate time series generated on demand instead of being stored. The k-th surrogate of a neuron is regenerated
+    from its own random stream, see surrogate_random_state. Behaves like the dictionary returned by
+    timeseries_to_surrogates, that is surrogates[neuron][k] is the k-th surrogate time series of that neuron.
+    """
+
+    def __init__(self, timeseries, n=10, factor=2, seed=0):
+        """
+        :param timeseries: dictionary of time series indexed by neuron
+        :param n: number of surrogates for each neuron
+        :param factor: see randomize_intervals
+        :param seed: seed for all random streams
+        """
+        self.timeseries = timeseries
+        self.n = n
+        self.factor = factor
+        self.seed = seed
+
+    def surrogate(self, neuron, k):
+        """Returns the k-th surrogate time series of the neuron."""
+        if not 0 <= k < self.n: raise IndexError('Surrogate %d out of range' % k)
+        return randomize_intervals(self.timeseries[neuron], factor=self.factor,
+                                   random_state=surrogate_random_state(self.seed, neuron, k))
+
+    def __getitem__(self, neuron):
+        if neuron not in self.timeseries: raise KeyError(neuron)
+        return NeuronSurrogates(self, neuron)
+
+    def __contains__(self, neuron):
+        return neuron in self.timeseries
+
+    def __iter__(self):
+        return iter(self.timeseries)
+
+    def __len__(self):
+        return len(self.timeseries)
+
+    def keys(self):
+        return self.timeseries.keys()
+
+
+class NeuronSurrogates(object):
+    """Sequence of the surrogate time series of one neuron, see SurrogateTimeseries."""
+
+    def __init__(self, surrogates, neuron):
+        self.surrogates = surrogates
+        self.neuron = neuron
+
+    def __getitem__(self, k):
+        return self.surrogates.surrogate(self.neuron, k + self.surrogates.n if k < 0 else k)
+
+    def __len__(self):
+        return self.surrogates.n
+
+    def __iter__(self):
+        return (self[k] for k in range(len(self)))
+
 
+def timeseries_to_surrogates(timeseries, n=10, factor=2, seed=None, workers=1):
+    """
+    Generating surrogate timeseries (this can take a while)
+    :param timeseries: dictionary of time series indexed by neuron
+    :param n, factor: see surrogate_timeseries
+    :param seed: (optional) if given, each surrogate is drawn from its own random stream, and the surrogates are the
+    same as those of SurrogateTimeseries, otherwise they are drawn from the global random state
+    :param workers: number of worker processes, see parallel.map_shards; requires a seed, which is drawn from the global
+    random state if none is given
+    :return: dictionary of lists of surrogate time series indexed by neuron
+    """
+    if seed is None and workers == 1:
+        return dict([(key, surrogate_timeseries(timeseries[key], n=n, factor=factor)) for key in timeseries])
+    if seed is None: seed = np.random.randint(2**31)
+    if workers == 1:
+        return _materialize(SurrogateTimeseries(timeseries, n=n, factor=factor, seed=seed), list(timeseries))
+    trains = as_spiketrains(timeseries)
+    with SharedArrays(**trains.arrays()) as directory:
+        tasks = [(directory, begin, end, n, factor, seed) for begin, end in shards(len(trains), shard_n_for(workers))]
+        results = map_shards(_surrogates_shard, tasks, workers=workers)
+    return dict(item for result in results for item in result.items())
+
+
+def _materialize(surrogates, neurons):
+    """Returns a dictionary of lists of surrogate time series for the neurons."""
+    return dict((neuron, list(surrogates[neuron])) for neuron in neurons)
+
+
+def _shared_surrogates(arrays, n, factor, seed):
+    """SurrogateTimeseries for the spike trains shared by SharedArrays."""
+    trains = SpikeTrains.from_arrays(arrays)
+    return SurrogateTimeseries(trains, n=n, factor=factor, seed=seed), list(trains)
+
+
+def _surrogates_shard(directory, begin, end, n, factor, seed):
+    """Worker for timeseries_to_surrogates."""
+    surrogates, neurons = _shared_surrogates(shared_arrays(directory), n, factor, seed)
+    return _materialize(surrogates, neurons[begin:end])
+
+
+def timeseries_list (timeseries, sampling_rate=None):
+    """Returns the time series as list, e.g. those of SpikeTrains in the order of its neurons. If a sampling rate is
+    given, the time series are converted into sample indices, unless they are already."""
+    trains = list(timeseries.values()) if isinstance(timeseries, SpikeTrains) else timeseries
+    if sampling_rate is None: return trains
+    if isinstance(timeseries, SpikeTrains) and timeseries.sampling_rate == sampling_rate:
+        return [timeseries.ticks(neuron) for neuron in timeseries]
+    return [to_ticks(train, sampling_rate) for train in trains]
+
+
+def sampling_rate_of (timeseries):
+    """Sampling rate of SpikeTrains storing sample indices, otherwise None (time series in s)."""
+    return timeseries.sampling_rate if isinstance(timeseries, SpikeTrains) else None
+
+
+def concatenated_timeseries (timeseries, sampling_rate=None):
+    """Returns all time series (list or SpikeTrains) concatenated, and for each event the index of its time series.
+    For contiguous SpikeTrains the concatenated time series is a view. If a sampling rate is given, the events are
+    sample indices."""
+    trains = as_spiketrains(timeseries)
+    if sampling_rate is not None and trains.sampling_rate == sampling_rate:
+        times, offsets = trains.concatenated(seconds=False)
+    else:
+        times, offsets = trains.concatenated()
+        if sampling_rate is not None: times = to_ticks(times, sampling_rate)
+    labels = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    return times, labels
+
+
+def all_timelag_hist (timeseries, targets=None, min_timelag=-0.005, max_timelag=0.005, bin_n=100):
+    """
+    Count histograms of the time lags for all pairs of time series at once. All (presynaptic) time series are
+    concatenated and the time lags to each target (postsynaptic) time series are looked up in a single vectorized
+    pass, therefore the loop runs over the targets only and not over all pairs.
+    If the time series are SpikeTrains storing sample indices, all time lags are computed and binned in samples.
+    :param timeseries: list (or SpikeTrains) of (presynaptic) time series
+    :param targets: (optional) list of (postsynaptic) time series, default: timeseries
+    :return: hist: counts indexed by (pre, post, bin)
+             bins: bin edges
+    """
+    sampling_rate = sampling_rate_of(timeseries)
+    if targets is None: targets = timeseries_list(timeseries, sampling_rate)
+    bins = timelag_bins(min_timelag, max_timelag, bin_n)
+    times, labels = concatenated_timeseries(timeseries, sampling_rate)
+    hist = np.zeros((len(timeseries), len(targets), bin_n), dtype=np.int64)
+    for post, target in enumerate(targets):
+        if sampling_rate is not None: target = to_ticks(target_times(target), sampling_rate)
+        time_lags, index = nearest_timelags(times, target)
+        hist[:, post] = labeled_timelag_hist(time_lags, labels[index], len(timeseries), bins, sampling_rate)
+    return hist, bins
+
+
+def binned_timelag_hists (sources, targets, min_timelag=-0.005, max_timelag=0.005, bin_n=100, oversampling=10,
+                          origin=None, batch_bins=2**18, target_chunk=64):
+    """
+    Count histograms of the time lags for all pairs of source and target time series from binned spike trains, using
+    FFT based cross-correlation. Note: This is a different statistic than the event based histograms (e.g.
+    all_timelag_hist), which count the time lags to the nearest preceding and succeeding target event only. These are
+    cross-correlograms counting all pairs of events within min_timelag..max_timelag, which only agree with the former
+    if the target fires at most once in that window around each source event, that is not for dense spike trains.
+    As for the event based histograms, an event is not paired with itself (zero time lag), if source and target are
+    the same time series.
+
+    The spike trains are binned at the histogram resolution divided by oversampling, therefore each time lag is
+    resolved up to one such time bin, and could be counted in the neighbouring histogram bin if it is within one time
+    bin of a bin edge. Original and surrogates are binned the same way. The recording is processed in batches of
+    blocks: the spectra of the source blocks are computed once for each batch and multiplied with those of all
+    targets (as matrix product for each frequency), and only the resulting counts are kept, so that memory does not
+    grow with the recording length. Cost grows with the number of time bins rather than events, so this is faster for
+    dense, high-rate spike trains only.
+    :param sources: list (or SpikeTrains) of (presynaptic) time series
+    :param targets: list (or SpikeTrains) of (postsynaptic) time series
+    :param oversampling: number of time bins per histogram bin
+    :param origin: (optional) time of the first time bin, default: first event; use the same origin for all calls
+    whose histograms are compared
+    :param batch_bins: number of time bins processed at once
+    :param target_chunk: number of targets multiplied with the source spectra at once
+    :return: hist: counts indexed by (source, target, bin)
+             bins: bin edges
+    """
+    sources, targets = timeseries_list(sources), timeseries_list(targets)
+    bins = timelag_bins(min_timelag, max_timelag, bin_n)
+    nonempty = [train for train in sources + targets if len(train) > 0]
+    if len(sources) == 0 or len(targets) == 0 or len(nonempty) == 0:
+        return np.zeros((len(sources), len(targets), bin_n), dtype=np.int64), bins
+    width = (max_timelag - min_timelag) / bin_n / oversampling
+    if origin is None: origin = min(train[0] for train in nonempty)
+    length = int(np.floor((max(train[-1] for train in nonempty) - origin) / width)) + 1
+    first_lag = int(np.round(min_timelag / width))  # time lags in time bins are first_lag..first_lag+span-1
+    span = bin_n * oversampling
+    fft_n = 1 << int(np.ceil(np.log2(4 * span)))
+    block = fft_n - span  # each block of the source is correlated with the target block extended by the time lags
+    block_n = max(1, batch_bins // block)
+
+    def binned(trains, begin, n):
+        """Counts in the time bins begin..begin+n-1 for each train, only looking at the events within."""
+        counts = np.zeros((len(trains), n))
+        for i, train in enumerate(trains):
+            lo, hi = np.searchsorted(train, origin + np.array([begin - 1, begin + n + 1]) * width)
+            index = np.floor((np.asarray(train[lo:hi]) - origin) / width).astype(np.int64) - begin
+            counts[i] = np.bincount(index[(index >= 0) & (index < n)], minlength=n)
+        return counts
 
-def all_timelag_standardscore (timeseries, timeseries_surrogates):
-    """Compute standardscore time histograms"""
-    all_std_score = []
-    all_timeseries_hist = []
-    for pair in product(timeseries, repeat=2):
-        timelags, std_score, timeseries_hist,surrogates_mean, surrogates_std \
-            = timelag_standardscore(timeseries[pair[0]], timeseries[pair[1]], timeseries_surrogates[pair[1]])
-        logging.info ( "Timeseries %d->%d" % pair )
-        all_std_score.append((pair, std_score))
-        all_timeseries_hist.append((pair, timeseries_hist))
-        # if logging.getLogger().getEffectiveLevel()==logging.DEBUG:
-        #     plot_pair_func(timelags, timeseries_hist, surrogates_mean, surrogates_std, std_score,
-        #                    "Timeseries %d->%d" % pair)
-        #     plt.show()
-    return timelags, dict(all_std_score), dict(all_timeseries_hist)
+    counts = np.zeros((len(sources), len(targets), bin_n))
+    for begin in range(0, length, block_n * block):
+        n = min(block_n, -(-(length - begin) // block))
+        source_counts = binned(sources, begin, n * block)
+        if not source_counts.any(): continue
+        source = np.fft.rfft(source_counts.reshape(len(sources), n, block), n=fft_n, axis=2)  # zero padded
+        source = source.transpose(2, 0, 1).conj()  # (frequency, source, block)
+        for chunk_begin in range(0, len(targets), target_chunk):
+            chunk = targets[chunk_begin:chunk_begin + target_chunk]
+            target_counts = binned(chunk, begin + first_lag, n * block + span)
+            if not target_counts.any(): continue
+            windows = np.lib.stride_tricks.as_strided(  # overlapping target blocks of fft_n time bins, not copied
+                target_counts, shape=(len(chunk), n, fft_n),
+                strides=(target_counts.strides[0], block * target_counts.strides[1], target_counts.strides[1]))
+            target = np.fft.rfft(windows, axis=2).transpose(2, 1, 0)  # (frequency, block, target)
+            correlation = np.fft.irfft(np.matmul(source, target), n=fft_n, axis=0)[:span]  # (time lag, source, target)
+            counts[:, chunk_begin:chunk_begin + len(chunk)] += \
+                correlation.reshape(bin_n, oversampling, len(sources), len(chunk)).sum(1).transpose(1, 2, 0)
+    hist = np.rint(counts).astype(np.int64)
+    if 0 <= -first_lag < span:  # remove the coincidences of each event with itself from the zero time lag bin
+        zero_bin = -first_lag // oversampling
+        for i, j in _same_timeseries(sources, targets):
+            hist[i, j, zero_bin] -= _zero_timelag_count(sources[i])
+    return hist, bins
 
 
-def all_peaks (timelags, std_score_dict, structural_delay_dict=None, minimal_synapse_delay=0):
+def _same_timeseries(sources, targets):
+    """Returns pairs (i, j) of indices of sources and targets that are the same time series."""
+    by_key = dict()
+    for i, source in enumerate(sources):
+        if len(source) > 0: by_key.setdefault((len(source), source[0], source[-1]), []).append(i)
+    return [(i, j) for j, target in enumerate(targets) if len(target) > 0
+            for i in by_key.get((len(target), target[0], target[-1]), [])
+            if sources[i] is target or np.array_equal(sources[i], target)]
+
+
+def _zero_timelag_count(timeseries):
+    """Number of pairs of events with zero time lag in a time series with itself, including each event with itself."""
+    _, counts = np.unique(timeseries, return_counts=True)
+    return np.sum(counts.astype(np.int64) ** 2)
+
+
+def cross_correlogram (timeseries1, timeseries2, min_timelag=-0.005, max_timelag=0.005, bin_n=100, oversampling=10):
+    """Count histogram of all time lags from events in the first to events in the second time series within
+    min_timelag..max_timelag, see binned_timelag_hists. Same return values as timelag_hist."""
+    hist, bins = binned_timelag_hists([timeseries1], [timeseries2], min_timelag=min_timelag, max_timelag=max_timelag,
+                                      bin_n=bin_n, oversampling=oversampling)
+    return hist[0, 0], bins
+
+
+BACKENDS = ('event', 'fft')
+
+
+def standardscore_from_sums (timeseries_hist, surrogates_sum, surrogates_sum_of_squares, n):
+    """Returns the standard score as well as mean and (population) standard deviation for the counts from n surrogate
+    timeseries given the sum and the sum of squares of their counts. Sums of integer counts are exact, therefore the
+    variance is computed as (n * sum_of_squares - sum**2) / n**2 without cancellation."""
+    surrogates_mean = surrogates_sum / n
+    surrogates_std = np.sqrt(n * surrogates_sum_of_squares - surrogates_sum ** 2) / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std_score = (timeseries_hist - surrogates_mean) / surrogates_std
+    return std_score, surrogates_mean, surrogates_std
+
+
+def recurrence_time_cdf (timeseries, times):
+    """
+    Distribution of the recurrence times of a renewal process with the inter-spike intervals of the time series, that
+    is the time from a random time point to the next (or from the previous) event, G(t) = E[min(I, t)] / E[I] for
+    intervals I, evaluated from the sorted intervals at once for all times.
+    :param timeseries: time series with at least two events
+    :param times: array of (non-negative) times
+    :return: array of probabilities
+    """
+    intervals = np.sort(np.diff(timeseries))
+    sums = np.hstack((0, np.cumsum(intervals)))
+    times = np.clip(times, 0, None)
+    shorter = np.searchsorted(intervals, times, side='left')
+    return (sums[shorter] + times * (len(intervals) - shorter)) / sums[-1]
+
+
+def analytic_timelag_null (timeseries, min_timelag=-0.005, max_timelag=0.005, bin_n=100, pairs=None):
+    """
+    Mean and standard deviation of the counts in the time lag histograms (see all_timelag_hist) for independent
+    time series, without surrogates. Interval-randomized surrogates keep the inter-spike intervals of the
+    postsynaptic time series but destroy the timing relative to the presynaptic events. Therefore, the postsynaptic
+    time series is modelled as renewal process with its empirical intervals: the time lag from a presynaptic event to
+    the succeeding (preceding) postsynaptic event is a forward (backward) recurrence time, and falls into the bin
+    [a, b) with probability p = G(b) - G(a) (G(-a) - G(-b)), see recurrence_time_cdf. Each of the n presynaptic events
+    between the first and the last postsynaptic event contributes one preceding and one succeeding time lag (events
+    outside are too far away), so that the counts have mean n p and variance n p (1 - p).
+    Note: This is an approximation for sparse, Poisson-like spike trains only. The model neither accounts for the
+    local interval jitter of the surrogates (factor in randomize_intervals), which keep the postsynaptic events near
+    their original times, nor for the correlation between presynaptic events that fall into the same postsynaptic
+    interval. For bursty spike trains the mean could be off by tens of percent and the standard scores are too
+    large. Therefore it is not used for the standard scores (see all_timelag_standardscore_array), only as a quick
+    estimate of the expected counts without surrogates.
+    :param timeseries: list (or SpikeTrains) of time series
+    :param pairs: (optional) array of (pre, post) indices into timeseries, default: all pairs
+    :return: mean, std: arrays indexed by (pre, post, bin), or by (pair, bin) if pairs are given
+    """
+    trains = timeseries_list(timeseries)
+    bins = timelag_bins(min_timelag, max_timelag, bin_n)
+    if pairs is None:
+        pairs = np.array(list(product(range(len(trains)), repeat=2)), dtype=np.int64).reshape(-1, 2)
+        shape = (len(trains), len(trains), bin_n)
+    else:
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        shape = (len(pairs), bin_n)
+    p_preceding = np.zeros((len(trains), bin_n))
+    p_succeeding = np.zeros((len(trains), bin_n))
+    first, last = np.zeros(len(trains)), np.zeros(len(trains))
+    for post, train in enumerate(trains):
+        if len(train) < 2: continue  # no intervals, no time lags expected
+        cdf = recurrence_time_cdf(train, np.abs(bins))
+        p_preceding[post] = np.where(bins[1:] <= 0, cdf[:-1] - cdf[1:], 0) + \
+                            np.where((bins[:-1] < 0) & (bins[1:] > 0), cdf[:-1], 0)
+        p_succeeding[post] = np.where(bins[:-1] >= 0, cdf[1:] - cdf[:-1], 0) + \
+                             np.where((bins[:-1] < 0) & (bins[1:] > 0), cdf[1:], 0)
+        first[post], last[post] = train[0], train[-1]
+    mean = np.zeros((len(pairs), bin_n))
+    variance = np.zeros((len(pairs), bin_n))
+    for pre in np.unique(pairs[:, 0]):
+        rows = np.flatnonzero(pairs[:, 0] == pre)
+        posts = pairs[rows, 1]
+        n_preceding = np.searchsorted(trains[pre], last[posts], side='right') - \
+                      np.searchsorted(trains[pre], first[posts], side='right')
+        n_succeeding = np.searchsorted(trains[pre], last[posts], side='left') - \
+                       np.searchsorted(trains[pre], first[posts], side='left')
+        p1, p2 = p_preceding[posts], p_succeeding[posts]
+        mean[rows] = n_preceding[:, None] * p1 + n_succeeding[:, None] * p2
+        variance[rows] = n_preceding[:, None] * p1 * (1 - p1) + n_succeeding[:, None] * p2 * (1 - p2)
+    return mean.reshape(shape), np.sqrt(variance).reshape(shape)
+
+
+def all_timelag_sums (timeseries, targets, targets_surrogates, n, min_timelag=-0.005, max_timelag=0.005, bin_n=100):
+    """
+    Count histograms for all pairs of time series and targets, as well as sum and sum of squares of the counts for
+    the first n surrogates of the targets.
+    :return: timeseries_hist, surrogates_sum, surrogates_sum_of_squares: arrays indexed by (pre, post, bin)
+             bins: bin edges
+    """
+    timeseries_hist, bins = all_timelag_hist(timeseries, targets, min_timelag=min_timelag, max_timelag=max_timelag,
+                                             bin_n=bin_n)
+    surrogates_sum = np.zeros_like(timeseries_hist)
+    surrogates_sum_of_squares = np.zeros_like(timeseries_hist)
+    for k in range(n):
+        surrogates_hist, _ = all_timelag_hist(timeseries, [surrogates[k] for surrogates in targets_surrogates],
+                                              min_timelag=min_timelag, max_timelag=max_timelag, bin_n=bin_n)
+        surrogates_sum += surrogates_hist
+        surrogates_sum_of_squares += surrogates_hist ** 2
+    return timeseries_hist, surrogates_sum, surrogates_sum_of_squares, bins
+
+
+def pairs_timelag_sums (timeseries, timeseries_surrogates, pairs, n, min_timelag=-0.005, max_timelag=0.005,
+                        bin_n=100, first=0):
+    """
+    Count histograms as well as sum and sum of squares of the counts for the first n surrogates, only for the given
+    pairs. For each target, only its candidate presynaptic time series are concatenated and looked up, and targets
+    without candidates (and their surrogates) are skipped entirely.
+    :param timeseries: list (or SpikeTrains) of time series
+    :param timeseries_surrogates: list (same order as timeseries) of lists of surrogate time series
+    :param pairs: array of (pre, post) indices into timeseries
+    :param first: (optional) skip the surrogates before, that is only use surrogates first..n-1
+    :return: timeseries_hist, surrogates_sum, surrogates_sum_of_squares: arrays indexed by (pair, bin)
+             bins: bin edges
+    """
+    sampling_rate = sampling_rate_of(timeseries)
+    trains = timeseries_list(timeseries, sampling_rate)
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    bins = timelag_bins(min_timelag, max_timelag, bin_n)
+    timeseries_hist = np.zeros((len(pairs), bin_n), dtype=np.int64)
+    surrogates_sum = np.zeros_like(timeseries_hist)
+    surrogates_sum_of_squares = np.zeros_like(timeseries_hist)
+    order = np.argsort(pairs[:, 1], kind='stable')
+    posts, starts = np.unique(pairs[order, 1], return_index=True)
+    for post, rows in zip(posts, np.split(order, starts[1:])):
+        times, labels = concatenated_timeseries([trains[pre] for pre in pairs[rows, 0]])
+
+        def hist(target):
+            if sampling_rate is not None: target = to_ticks(target, sampling_rate)
+            time_lags, index = nearest_timelags(times, target)
+            return labeled_timelag_hist(time_lags, labels[index], len(rows), bins, sampling_rate)
+
+        timeseries_hist[rows] = hist(trains[post])
+        for k in range(first, n):
+            surrogates_hist = hist(timeseries_surrogates[post][k])
+            surrogates_sum[rows] += surrogates_hist
+            surrogates_sum_of_squares[rows] += surrogates_hist ** 2
+    return timeseries_hist, surrogates_sum, surrogates_sum_of_squares, bins
+
+
+def binned_timelag_sums (timeseries, timeseries_surrogates, n, min_timelag=-0.005, max_timelag=0.005, bin_n=100,
+                         posts=None, oversampling=10, max_bytes=2**30):
+    """
+    Same as all_timelag_sums, but using the binned (FFT based) cross-correlograms, see binned_timelag_hists. The
+    targets and their surrogates are processed together against the same source spectra, in groups of targets whose
+    counts fit into max_bytes.
+    :param posts: (optional) indices of the targets, default: all
+    :param max_bytes: memory for the counts of a group of targets and their surrogates
+    :return: timeseries_hist, surrogates_sum, surrogates_sum_of_squares: arrays indexed by (pre, post, bin)
+             bins: bin edges
+    """
+    trains = timeseries_list(timeseries)
+    if posts is None: posts = range(len(trains))
+    posts = list(posts)
+    nonempty = [train for train in trains if len(train) > 0]
+    origin = min(train[0] for train in nonempty) if len(nonempty) > 0 else 0
+    bins = timelag_bins(min_timelag, max_timelag, bin_n)
+    timeseries_hist = np.zeros((len(trains), len(posts), bin_n), dtype=np.int64)
+    surrogates_sum = np.zeros_like(timeseries_hist)
+    surrogates_sum_of_squares = np.zeros_like(timeseries_hist)
+    group_n = max(1, max_bytes // (8 * max(1, len(trains)) * (n + 1) * bin_n))
+    for group_begin in range(0, len(posts), group_n):
+        group = posts[group_begin:group_begin + group_n]
+        targets = [trains[post] for post in group] + \
+                  [timeseries_surrogates[post][k] for post in group for k in range(n)]
+        hist, _ = binned_timelag_hists(trains, targets, min_timelag=min_timelag, max_timelag=max_timelag,
+                                       bin_n=bin_n, oversampling=oversampling, origin=origin)
+        columns = slice(group_begin, group_begin + len(group))
+        timeseries_hist[:, columns] = hist[:, :len(group)]
+        surrogates_hist = hist[:, len(group):].reshape(len(trains), len(group), n, bin_n)
+        surrogates_sum[:, columns] = surrogates_hist.sum(2)
+        surrogates_sum_of_squares[:, columns] = (surrogates_hist ** 2).sum(2)
+    return timeseries_hist, surrogates_sum, surrogates_sum_of_squares, bins
+
+
+def _shared_timeseries(directory, n, surrogates_spec):
+    """Returns the spike trains shared by all_timelag_standardscore_array and the list of their surrogates, which are
+    either shared or, if surrogates_spec = (factor, seed) is given, generated on demand."""
+    arrays = shared_arrays(directory)
+    trains = SpikeTrains.from_arrays(arrays)
+    if surrogates_spec is None:
+        surrogates = timeseries_list(SpikeTrains.from_arrays(arrays, prefix='surrogate_'))
+        timeseries_surrogates = [surrogates[post * n:(post + 1) * n] for post in range(len(trains))]
+    else:
+        surrogates, neurons = _shared_surrogates(arrays, n, *surrogates_spec)
+        timeseries_surrogates = [surrogates[neuron] for neuron in neurons]
+    return trains, timeseries_surrogates
+
+
+def _all_timelag_sums_shard(directory, begin, end, n, min_timelag, max_timelag, bin_n, surrogates_spec=None):
+    """Worker for all_timelag_standardscore_array, computing the sums for the targets begin..end-1."""
+    trains, timeseries_surrogates = _shared_timeseries(directory, n, surrogates_spec)
+    timeseries_hist, surrogates_sum, surrogates_sum_of_squares, _ = all_timelag_sums(
+        trains, timeseries_list(trains)[begin:end], timeseries_surrogates[begin:end], n,
+        min_timelag=min_timelag, max_timelag=max_timelag, bin_n=bin_n)
+    logging.info("Targets %d..%d done" % (begin, end - 1))
+    return timeseries_hist, surrogates_sum, surrogates_sum_of_squares
+
+
+def _pairs_timelag_sums_shard(directory, pairs, n, min_timelag, max_timelag, bin_n, surrogates_spec=None):
+    """Worker for all_timelag_standardscore_array, computing the sums for the given pairs."""
+    trains, timeseries_surrogates = _shared_timeseries(directory, n, surrogates_spec)
+    timeseries_hist, surrogates_sum, surrogates_sum_of_squares, _ = pairs_timelag_sums(
+        trains, timeseries_surrogates, pairs, n, min_timelag=min_timelag, max_timelag=max_timelag, bin_n=bin_n)
+    logging.info("%d pairs done" % len(pairs))
+    return timeseries_hist, surrogates_sum, surrogates_sum_of_squares
+
+
+def all_timelag_standardscore_array (timeseries, timeseries_surrogates, min_timelag=-0.005, max_timelag=0.005,
+                                     bin_n=100, workers=1, pairs=None, backend='event'):
+    """
+    Compute standard score time histograms for all pairs at once, see timelag_standardscore.
+    :param timeseries: list (or SpikeTrains) of time series
+    :param timeseries_surrogates: list (same order as timeseries) of lists of surrogate time series, or of
+    NeuronSurrogates, in which case each surrogate is generated when needed and only its histogram is kept
+    :param workers: number of worker processes, see parallel.map_shards; the targets are split into shards and all
+    time series are shared with the workers through memory mapped files, surrogates generated on demand are
+    regenerated by the workers
+    :param pairs: (optional) array of (pre, post) indices into timeseries, if given only these pairs are computed
+    :param backend: 'event' for the time lags to the nearest events, or 'fft' for binned cross-correlograms (see
+    binned_timelag_hists, computed in this process); the latter count all time lags within the bins, which is a
+    different statistic for dense spike trains, therefore the standard scores of both backends are not comparable
+    :return: timelags: midpoints of bins in ms
+             std_score, timeseries_hist, surrogates_mean, surrogates_std: arrays indexed by (pre, post, bin), or by
+             (pair, bin) if pairs are given
+    """
+    if backend not in BACKENDS: raise ValueError('Unknown backend %s' % backend)
+    n = min(len(surrogates) for surrogates in timeseries_surrogates) if len(timeseries_surrogates) > 0 else 0
+    if pairs is not None: pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    bins = timelag_bins(min_timelag, max_timelag, bin_n)
+    if backend == 'fft':
+        posts = range(len(timeseries)) if pairs is None else np.unique(pairs[:, 1])
+        timeseries_hist, surrogates_sum, surrogates_sum_of_squares, _ = binned_timelag_sums(
+            timeseries, timeseries_surrogates, n, min_timelag=min_timelag, max_timelag=max_timelag, bin_n=bin_n,
+            posts=posts)
+        if pairs is not None:
+            columns = np.searchsorted(posts, pairs[:, 1])
+            timeseries_hist, surrogates_sum, surrogates_sum_of_squares = \
+                [sums[pairs[:, 0], columns] for sums in (timeseries_hist, surrogates_sum, surrogates_sum_of_squares)]
+    elif workers == 1 and pairs is None:
+        timeseries_hist, surrogates_sum, surrogates_sum_of_squares, _ = all_timelag_sums(
+            timeseries, timeseries_list(timeseries), timeseries_surrogates, n,
+            min_timelag=min_timelag, max_timelag=max_timelag, bin_n=bin_n)
+    elif workers == 1:
+        timeseries_hist, surrogates_sum, surrogates_sum_of_squares, _ = pairs_timelag_sums(
+            timeseries, timeseries_surrogates, pairs, n, min_timelag=min_timelag, max_timelag=max_timelag,
+            bin_n=bin_n)
+    else:
+        arrays = as_spiketrains(timeseries).arrays()
+        on_demand = all(isinstance(surrogates, NeuronSurrogates) for surrogates in timeseries_surrogates)
+        if on_demand:
+            generator = timeseries_surrogates[0].surrogates if len(timeseries_surrogates) > 0 else None
+            arrays['neurons'] = np.array([surrogates.neuron for surrogates in timeseries_surrogates])
+            surrogates_spec = (generator.factor, generator.seed) if generator is not None else None
+        else:
+            arrays.update(SpikeTrains.from_list([surrogates[k] for surrogates in timeseries_surrogates
+                                                 for k in range(n)]).arrays(prefix='surrogate_'))
+            surrogates_spec = None
+        target_shards = shards(len(timeseries), shard_n_for(workers))
+        with SharedArrays(**arrays) as directory:
+            if pairs is None:
+                tasks = [(directory, begin, end, n, min_timelag, max_timelag, bin_n, surrogates_spec)
+                         for begin, end in target_shards]
+                results = map_shards(_all_timelag_sums_shard, tasks, workers=workers)
+            else:
+                rows = [np.flatnonzero((pairs[:, 1] >= begin) & (pairs[:, 1] < end)) for begin, end in target_shards]
+                tasks = [(directory, pairs[shard_rows], n, min_timelag, max_timelag, bin_n, surrogates_spec)
+                         for shard_rows in rows]
+                results = map_shards(_pairs_timelag_sums_shard, tasks, workers=workers)
+        if pairs is None:
+            timeseries_hist, surrogates_sum, surrogates_sum_of_squares = \
+                [np.concatenate(sums, axis=1) for sums in zip(*results)]
+        else:
+            timeseries_hist, surrogates_sum, surrogates_sum_of_squares = \
+                [np.zeros((len(pairs), bin_n), dtype=np.int64) for i in range(3)]
+            for shard_rows, sums in zip(rows, results):
+                timeseries_hist[shard_rows], surrogates_sum[shard_rows], surrogates_sum_of_squares[shard_rows] = sums
+    timelags = (bins[:-1] + bins[1:])/2 * 1000  # ms
+    std_score, surrogates_mean, surrogates_std = standardscore_from_sums(timeseries_hist, surrogates_sum,
+                                                                         surrogates_sum_of_squares, n)
+    return timelags, std_score, timeseries_hist, surrogates_mean, surrogates_std
+
+
+def candidate_pairs (timeseries, pairs=None, min_spike_count=0):
+    """
+    Neuron pairs for which standard scores are computed, e.g. structurally connected pairs from
+    structure.all_overlaps, restricted to neurons with enough spikes.
+    :param timeseries: dictionary (or SpikeTrains) of time series indexed by neuron
+    :param pairs: (optional) candidate neuron pairs, default: all pairs
+    :param min_spike_count: (optional) minimum number of spikes of both neurons
+    :return: list of neuron pairs
+    """
+    if pairs is None: pairs = product(timeseries, repeat=2)
+    return [(pre, post) for pre, post in pairs if pre in timeseries and post in timeseries
+            and len(timeseries[pre]) >= min_spike_count and len(timeseries[post]) >= min_spike_count]
+
+
+def all_timelag_standardscore (timeseries, timeseries_surrogates, workers=1, pairs=None, backend='event'):
+    """Compute standardscore time histograms for time series (dictionary or SpikeTrains) indexed by neuron, see
+    all_timelag_standardscore_array. If neuron pairs are given (see candidate_pairs), only those are computed and
+    returned."""
+    neurons, index_pairs = _index_pairs(timeseries, pairs)
+    timelags, std_score, timeseries_hist, _, _ = all_timelag_standardscore_array(
+        timeseries if isinstance(timeseries, SpikeTrains) else [timeseries[neuron] for neuron in neurons],
+        [timeseries_surrogates[neuron] for neuron in neurons],
+        workers=workers, pairs=None if pairs is None else index_pairs, backend=backend)
+    all_std_score, all_timeseries_hist = _pair_dicts(neurons, index_pairs, pairs is None, std_score,
+                                                     timeseries_hist)
+    logging.info("Timeseries for %d pairs" % len(all_std_score))
+    return timelags, all_std_score, all_timeseries_hist
+
+
+def _index_pairs(timeseries, pairs=None):
+    """Returns the neurons and the pairs as (pre, post) positions in that list, by default all pairs."""
+    neurons = list(timeseries)
+    if pairs is None: return neurons, list(product(range(len(neurons)), repeat=2))
+    position = dict((neuron, i) for i, neuron in enumerate(neurons))
+    return neurons, [(position[pre], position[post]) for pre, post in pairs]
+
+
+def _pair_dicts(neurons, index_pairs, all_pairs, *arrays):
+    """Dictionaries indexed by neuron pairs from arrays indexed by (pair, ...), or by (pre, post, ...) for all
+    pairs."""
+    if all_pairs: arrays = [array.reshape((-1,) + array.shape[2:]) for array in arrays]
+    return [dict(((neurons[pre], neurons[post]), array[i]) for i, (pre, post) in enumerate(index_pairs))
+            for array in arrays]
+
+
+def adaptive_timelag_standardscore_array (timeseries, timeseries_surrogates, n_initial=5, n_step=10, band=1.0,
+                                          min_timelag=-0.005, max_timelag=0.005, bin_n=100, pairs=None):
+    """
+    Compute standard score time histograms with the number of surrogates adapted for each pair. All pairs start with
+    n_initial surrogates, and in each round n_step surrogates are added only for the pairs whose peak standard score
+    (largest absolute value) is ambiguous, or infinite because the surrogates did not vary yet. A peak z is ambiguous
+    if the provisional Benjamini-Hochberg threshold for all standard scores (see BH_threshold) is within
+    z +/- (band + z sqrt(2 / n)), the latter accounting for the relative error of about 1 / sqrt(2 n) of the
+    standard deviation estimated from n surrogates. Pairs that are clearly (non-)significant keep their surrogates,
+    until all pairs are decided or all surrogates are used.
+    :param timeseries: list (or SpikeTrains) of time series
+    :param timeseries_surrogates: list (same order as timeseries) of lists of surrogate time series, or of
+    NeuronSurrogates, e.g. from SurrogateTimeseries with n=100 for the maximal number of surrogates
+    :param n_initial: number of surrogates for all pairs
+    :param n_step: number of surrogates added in each round
+    :param band: minimal margin around the threshold for ambiguous standard scores
+    :param pairs: (optional) array of (pre, post) indices into timeseries, if given only these pairs are computed
+    :return: timelags: midpoints of bins in ms
+             std_score, timeseries_hist, surrogates_mean, surrogates_std: arrays indexed by (pre, post, bin), or by
+             (pair, bin) if pairs are given
+             n_used: number of surrogates for each pair, indexed by (pre, post) or pair
+    """
+    if pairs is None:
+        shape = (len(timeseries), len(timeseries))
+        pairs = np.array(list(product(range(len(timeseries)), repeat=2)), dtype=np.int64).reshape(-1, 2)
+    else:
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        shape = (len(pairs),)
+    n_max = min(len(surrogates) for surrogates in timeseries_surrogates) if len(timeseries_surrogates) > 0 else 0
+    bins = timelag_bins(min_timelag, max_timelag, bin_n)
+    timeseries_hist, surrogates_sum, surrogates_sum_of_squares = \
+        [np.zeros((len(pairs), bin_n), dtype=np.int64) for i in range(3)]
+    n_used = np.zeros(len(pairs), dtype=np.int64)
+    active = np.arange(len(pairs))
+    first = 0
+    while len(active) > 0 and first < n_max:
+        last = min(n_max, first + (n_initial if first == 0 else n_step))
+        hist, sums, sums_of_squares, _ = pairs_timelag_sums(
+            timeseries, timeseries_surrogates, pairs[active], last, min_timelag=min_timelag, max_timelag=max_timelag,
+            bin_n=bin_n, first=first)
+        timeseries_hist[active] = hist
+        surrogates_sum[active] += sums
+        surrogates_sum_of_squares[active] += sums_of_squares
+        n_used[active] = last
+        std_score, surrogates_mean, surrogates_std = standardscore_from_sums(
+            timeseries_hist, surrogates_sum, surrogates_sum_of_squares, n_used[:, np.newaxis])
+        finite = np.isfinite(std_score)
+        peak = np.max(np.where(np.isnan(std_score), -np.inf, np.abs(std_score)), axis=1)
+        if not finite.any():  # no threshold yet, all pairs need more surrogates
+            z_thr = np.nan
+            ambiguous = np.ones(len(pairs), dtype=bool)
+        else:
+            try:
+                z_thr = BH_threshold(std_score[finite])
+            except ValueError:  # nothing significant yet, threshold as low as possible
+                z_thr = np.sqrt(2) * erfcinv(1 / np.sum(finite))
+            uncertainty = band + np.sqrt(2 / n_used) * peak  # two standard errors of the estimated std
+            ambiguous = np.isposinf(peak) | (np.abs(peak - z_thr) < uncertainty)
+        logging.info('%d surrogates: %d of %d pairs ambiguous for |z| > %f'
+                     % (last, np.sum(ambiguous[active]), len(pairs), z_thr))
+        active = active[ambiguous[active]]
+        first = last
+    if len(pairs) == 0:
+        std_score, surrogates_mean, surrogates_std = [np.zeros((0, bin_n)) for i in range(3)]
+    timelags = (bins[:-1] + bins[1:])/2 * 1000  # ms
+    return (timelags,) + tuple(array.reshape(shape + (bin_n,)) for array in
+                               (std_score, timeseries_hist, surrogates_mean, surrogates_std)) + (n_used.reshape(shape),)
+
+
+def adaptive_timelag_standardscore (timeseries, timeseries_surrogates, pairs=None, **kwargs):
+    """Compute standardscore time histograms for time series (dictionary or SpikeTrains) indexed by neuron with
+    adapted number of surrogates, see adaptive_timelag_standardscore_array.
+    :return: timelags, std_score_dict, timeseries_hist_dict and n_used_dict indexed by neuron pairs"""
+    neurons, index_pairs = _index_pairs(timeseries, pairs)
+    timelags, std_score, timeseries_hist, _, _, n_used = adaptive_timelag_standardscore_array(
+        timeseries if isinstance(timeseries, SpikeTrains) else [timeseries[neuron] for neuron in neurons],
+        [timeseries_surrogates[neuron] for neuron in neurons], pairs=None if pairs is None else index_pairs,
+        **kwargs)
+    all_std_score, all_timeseries_hist, all_n_used = _pair_dicts(neurons, index_pairs, pairs is None, std_score,
+                                                                 timeseries_hist, n_used)
+    logging.info("Timeseries for %d pairs with %d surrogates on average" % (len(all_std_score), np.mean(n_used)))
+    return timelags, all_std_score, all_timeseries_hist, all_n_used
+
+
+def sliding_timelag_standardscore (timeseries, timeseries_surrogates, window, step, begin=None, end=None,
+                                   min_timelag=-0.005, max_timelag=0.005, bin_n=100):
+    """
+    Time resolved standard scores for all pairs in overlapping windows [begin + i * step, begin + i * step + window)
+    computed in one sweep. Each time lag is counted for the block of length step containing its presynaptic spike,
+    and the counts for a window are the sum over its window / step consecutive blocks, which are computed for all
+    windows from the cumulative sum over the blocks. Note: Postsynaptic spikes just outside a window (by less than
+    max_timelag) could contribute to its counts, unlike restricting all time series to each window.
+    :param timeseries: dictionary (or SpikeTrains) of time series indexed by neuron
+    :param timeseries_surrogates: dictionary of lists of surrogate time series, or SurrogateTimeseries
+    :param window: length of the windows in s, must be a multiple of step
+    :param step: shift between windows in s
+    :param begin, end: (optional) time covered by the windows, default: first and last spike
+    :return: timelags: midpoints of bins in ms
+             window_begins: begin of each window in s
+             pairs: list of neuron pairs
+             std_score, timeseries_hist: arrays indexed by (window, pair, bin)
+    """
+    neurons = list(timeseries)
+    block_per_window = int(round(window / step))
+    if block_per_window < 1 or not np.isclose(block_per_window * step, window):
+        raise ValueError('Window length %f s is not a multiple of step %f s' % (window, step))
+    times, labels = concatenated_timeseries(timeseries if isinstance(timeseries, SpikeTrains)
+                                            else [timeseries[neuron] for neuron in neurons])
+    if begin is None: begin = times.min()
+    if end is None: end = np.nextafter(times.max(), np.inf)
+    block_n = int(np.ceil((end - begin) / step))
+    window_n = block_n - block_per_window + 1
+    if window_n < 1: raise ValueError('Window length %f s longer than the recording' % window)
+    window_begins = begin + step * np.arange(window_n)
+    bins = timelag_bins(min_timelag, max_timelag, bin_n)
+    timelags = (bins[:-1] + bins[1:])/2 * 1000  # ms
+
+    # label each presynaptic spike by its neuron and block, ignoring spikes outside [begin, end)
+    blocks = np.floor((times - begin) / step).astype(np.int64)
+    inside = (times >= begin) & (times < end) & (blocks < block_n)
+    times, labels = times[inside], labels[inside] * block_n + blocks[inside]
+
+    def window_hist(target):
+        time_lags, index = nearest_timelags(times, target)
+        block_hist = labeled_timelag_hist(time_lags, labels[index], len(neurons) * block_n, bins)
+        cumulative = np.cumsum(block_hist.reshape(len(neurons), block_n, bin_n), axis=1)
+        cumulative = np.concatenate((np.zeros((len(neurons), 1, bin_n), dtype=cumulative.dtype), cumulative), axis=1)
+        return (cumulative[:, block_per_window:] - cumulative[:, :window_n]).swapaxes(0, 1)  # (window, pre, bin)
+
+    shape = (window_n, len(neurons), len(neurons), bin_n)
+    timeseries_hist = np.zeros(shape, dtype=np.int64)
+    surrogates_sum = np.zeros(shape, dtype=np.int64)
+    surrogates_sum_of_squares = np.zeros(shape, dtype=np.int64)
+    n = min(len(timeseries_surrogates[neuron]) for neuron in neurons) if len(neurons) > 0 else 0
+    for post, neuron in enumerate(neurons):
+        timeseries_hist[:, :, post] = window_hist(timeseries[neuron])
+        for k in range(n):
+            surrogates_hist = window_hist(timeseries_surrogates[neuron][k])
+            surrogates_sum[:, :, post] += surrogates_hist
+            surrogates_sum_of_squares[:, :, post] += surrogates_hist ** 2
+        logging.info('Sliding windows for target %d of %d' % (post + 1, len(neurons)))
+    std_score, _, _ = standardscore_from_sums(timeseries_hist, surrogates_sum, surrogates_sum_of_squares, n)
+
+    pairs = list(product(neurons, repeat=2))
+    return timelags, window_begins, pairs, std_score.reshape(window_n, -1, bin_n), \
+           timeseries_hist.reshape(window_n, -1, bin_n)
+
+
+def succeeding_timelags (timeseries1, timeseries2, first=0):
+    """Returns the time lags from each event in the first time series to the succeeding event in the second time
+    series, if that is at position first or later, together with the index of the event in the first time series."""
+    succeeding = np.searchsorted(timeseries2, timeseries1, side='right')
+    index = np.flatnonzero((succeeding >= first) & (succeeding < len(timeseries2)))
+    return timeseries2[succeeding[index]] - timeseries1[index], index
+
+
+class IncrementalStandardScore(object):
+    """
+    Standard scores for all pairs of neurons accumulated from chunks of a growing recording. The counts for the time
+    lags are kept as state, and each new chunk of spikes only adds the time lags it contributes. Time lags crossing
+    the boundary between chunks are found by keeping the spikes of the last max(|min_timelag|, max_timelag) seconds.
+
+    Each surrogate time series is continued chunk by chunk: the intervals from the last spike before the chunk up to
+    its last spike are randomized (see randomize_intervals), using an independent random stream for each neuron,
+    surrogate and chunk. Note: The counts of each surrogate are kept (in contrast to their sum) to compute the variance,
+    that is memory for n x neurons**2 x bin_n integers.
+
+    Usage:
+        accumulator = IncrementalStandardScore(neurons)
+        for chunk in chunks:    # dictionaries of time series, each later than the previous
+            accumulator.add(chunk)
+            timelags, std_score_dict, timeseries_hist_dict = accumulator.standardscores()
+    """
+
+    def __init__(self, neurons, n=10, factor=2, seed=0, min_timelag=-0.005, max_timelag=0.005, bin_n=100):
+        """
+        :param neurons: list of neurons
+        :param n, factor, seed: see SurrogateTimeseries
+        :param min_timelag, max_timelag, bin_n: see timelag_hist
+        """
+        self.neurons = list(neurons)
+        self.n = n
+        self.factor = factor
+        self.seed = seed
+        self.bins = timelag_bins(min_timelag, max_timelag, bin_n)
+        self.span = max(abs(min_timelag), abs(max_timelag))
+        neuron_n = len(self.neurons)
+        self.timeseries_hist = np.zeros((neuron_n, neuron_n, bin_n), dtype=np.int64)
+        self.surrogates_hist = np.zeros((n, neuron_n, neuron_n, bin_n), dtype=np.int32)
+        self.chunk_n = 0
+        self.end = -np.inf
+        self.last = [None] * neuron_n
+        self.tail = [np.zeros(0)] * neuron_n
+        self.surrogates_tail = [[np.zeros(0)] * neuron_n for k in range(n)]
+
+    def add(self, chunk, end=None):
+        """
+        Add a chunk of spikes.
+        :param chunk: dictionary (or SpikeTrains) of the new spike times indexed by neuron; all spikes must be later
+        than those of the previous chunks, missing neurons did not spike
+        :param end: (optional) time up to which the recording is complete, default: the last spike so far
+        """
+        new = [np.asarray(chunk[neuron]) if neuron in chunk else np.zeros(0) for neuron in self.neurons]
+        if any(len(spikes) > 0 and spikes[0] < self.end for spikes in new):
+            raise ValueError('Chunk overlaps with previous chunks')
+        neuron_n = len(self.neurons)
+        new_surrogates = [[self._surrogate(i, k, new[i]) for i in range(neuron_n)] for k in range(self.n)]
+
+        # time lags from all new presynaptic spikes, and the succeeding time lags from the presynaptic spikes kept
+        # from previous chunks if the succeeding postsynaptic spike is a new one
+        new_times, new_labels = concatenated_timeseries(new)
+        tail_times, tail_labels = concatenated_timeseries(self.tail)
+        for k, targets_tail, targets_new in [(None, self.tail, new)] + \
+                [(k, self.surrogates_tail[k], new_surrogates[k]) for k in range(self.n)]:
+            hist = self.timeseries_hist if k is None else self.surrogates_hist[k]
+            for post in range(neuron_n):
+                target = np.hstack((targets_tail[post], targets_new[post]))
+                time_lags, index = nearest_timelags(new_times, target)
+                hist[:, post] += labeled_timelag_hist(time_lags, new_labels[index], neuron_n, self.bins)
+                time_lags, index = succeeding_timelags(tail_times, target, first=len(targets_tail[post]))
+                hist[:, post] += labeled_timelag_hist(time_lags, tail_labels[index], neuron_n, self.bins)
+
+        self.end = max([self.end if end is None else end] + [spikes[-1] for spikes in new if len(spikes) > 0])
+        self.tail = [self._keep(self.tail[i], new[i]) for i in range(neuron_n)]
+        for k in range(self.n):
+            self.surrogates_tail[k] = [self._keep(self.surrogates_tail[k][i], new_surrogates[k][i])
+                                       for i in range(neuron_n)]
+        for i in range(neuron_n):
+            if len(new[i]) > 0: self.last[i] = new[i][-1]
+        self.chunk_n += 1
+        logging.info('Added chunk %d with %d spikes up to %f s' % (self.chunk_n, len(new_times), self.end))
+
+    def _surrogate(self, i, k, spikes):
+        """Surrogate for the new spikes of the i-th neuron, continuing the intervals from its last spike."""
+        if len(spikes) == 0: return spikes
+        anchored = spikes if self.last[i] is None else np.hstack((self.last[i], spikes))
+        random_state = np.random.default_rng([self.seed, self.neurons[i], k, self.chunk_n])
+        surrogate = randomize_intervals(anchored, factor=self.factor, random_state=random_state)
+        return surrogate if self.last[i] is None else surrogate[1:]
+
+    def _keep(self, tail, spikes):
+        """Spikes that could still form time lags within the bins with spikes of later chunks."""
+        spikes = np.hstack((tail, spikes))
+        return spikes[np.searchsorted(spikes, self.end - self.span, side='left'):]
+
+    def standardscore_array(self):
+        """
+        Standard scores for the spikes so far, see all_timelag_standardscore_array.
+        :return: timelags, std_score, timeseries_hist, surrogates_mean, surrogates_std
+        """
+        surrogates_hist = self.surrogates_hist.astype(np.int64)
+        std_score, surrogates_mean, surrogates_std = standardscore_from_sums(
+            self.timeseries_hist, surrogates_hist.sum(0), (surrogates_hist ** 2).sum(0), self.n)
+        timelags = (self.bins[:-1] + self.bins[1:])/2 * 1000  # ms
+        return timelags, std_score, self.timeseries_hist, surrogates_mean, surrogates_std
+
+    def standardscores(self):
+        """
+        Standard scores for the spikes so far, see all_timelag_standardscore.
+        :return: timelags, std_score_dict, timeseries_hist_dict
+        """
+        timelags, std_score, timeseries_hist, _, _ = self.standardscore_array()
+        all_std_score, all_timeseries_hist = dict(), dict()
+        for (pre, post) in product(range(len(self.neurons)), repeat=2):
+            pair = self.neurons[pre], self.neurons[post]
+            all_std_score[pair] = std_score[pre, post]
+            all_timeseries_hist[pair] = timeseries_hist[pre, post].copy()
+        return timelags, all_std_score, all_timeseries_hist
+
+
+def stack_standardscores (std_score_dict, pairs=None):
+    """
+    Pack standard scores indexed by neuron pair into one array.
+    :param std_score_dict: standard scores indexed by neuron pair
+    :param pairs: (optional) pairs to include and their order, pairs without standard score are skipped
+    :return: pairs: list of pairs
+             std_score: array indexed by (pair, bin)
+    """
+    pairs = [pair for pair in (std_score_dict if pairs is None else pairs) if pair in std_score_dict]
+    if len(pairs) == 0: return pairs, np.zeros((0, 0))
+    return pairs, np.vstack([std_score_dict[pair] for pair in pairs])
+
+
+PEAK_KINDS = ('forward', 'reverse', 'forward_negative', 'reverse_negative')
+
+
+def all_peaks_array (timelags, std_score, offsets=None, minimal_synapse_delay=0, kinds=('forward',)):
+    """
+    Vectorized peak detection for standard scores stacked into an array, see all_peaks. Masks, threshold, argmax and
+    comparison with the threshold are done for all pairs at once, and several kinds of peaks are detected in the same
+    pass with a common threshold:
+        'forward': positive peaks at post-synaptic time lags, that is timelags > offset + minimal_synapse_delay
+        'reverse': positive peaks at pre-synaptic time lags, that is timelags < -(offset + minimal_synapse_delay)
+        'forward_negative', 'reverse_negative': negative peaks (inhibitory connections), score < -z_thr
+    The Benjamini-Hochberg threshold is computed from the standard scores at timelags > offset (and/or < -offset)
+    for the directions of all kinds.
+    :param timelags: array with time lags for standard scores
+    :param std_score: standard scores indexed by (pair, bin), or by (..., pair, bin), e.g. (window, pair, bin)
+    :param offsets: (optional) axonal delays for each pair
+    :param minimal_synapse_delay: (optional) time lag must be larger than this synapse delay (and axonal delay)
+    :param kinds: kinds of peaks, see PEAK_KINDS
+    :return: z_thr: threshold for standard score
+             peaks: dictionary indexed by kind of (score, timelag, significant), arrays indexed by (..., pair)
+    """
+    offsets = np.zeros(std_score.shape[-2]) if offsets is None else np.asarray(offsets, dtype=float)
+    window = {'forward': lambda margin: timelags[np.newaxis, :] > offsets[:, np.newaxis] + margin,
+              'reverse': lambda margin: timelags[np.newaxis, :] < -(offsets[:, np.newaxis] + margin)}
+    directions = set(kind.split('_')[0] for kind in kinds)
+
+    # first, collect all z values and determine threshold
+    use = np.zeros(std_score.shape[-2:], dtype=bool)
+    for direction in directions:
+        use |= window[direction](0)
+    z_thr = BH_threshold(std_score[np.broadcast_to(use, std_score.shape)])
+
+    # second, determine peak z value for each pair and check if above threshold
+    peaks = dict()
+    for kind in kinds:
+        direction, sign = kind.split('_')[0], -1 if kind.endswith('_negative') else 1
+        use = window[direction](minimal_synapse_delay)
+        signed_score = np.where(use, sign * std_score, -np.inf)
+        index_max = np.argmax(signed_score, axis=-1)
+        score_max = np.take_along_axis(signed_score, index_max[..., np.newaxis], axis=-1)[..., 0]
+        significant = np.any(use, axis=-1) & (score_max > z_thr)
+        peaks[kind] = sign * score_max, timelags[index_max], significant
+        logging.info('%s peaks: %d of %d with |z|>%f' % (kind, np.sum(significant), significant.size, z_thr))
+    return z_thr, peaks
+
+
+def all_peaks (timelags, std_score_dict, structural_delay_dict=None, minimal_synapse_delay=0, kind='forward'):
     """
     Return the largest standard score peak for each functional connection, rejecting false positives.
-    Implemented is the forward direction, that is looking for peaks at post-synaptic time lags
+    Implemented is the forward direction, that is looking for peaks at post-synaptic time lags, as well as the reverse
+    direction and negative peaks (inhibitory connections), see all_peaks_array.
 
     After converting z values into p values by p = erfc(z/sqrt(2), the Benjamini-Hochberg procedure is applied to
     control the false discovery rate in the multiple comparisons with a false discover rat fixed at one in all
@@ -139,55 +1188,32 @@ def all_peaks (timelags, std_score_dict, structural_delay_dict=None, minimal_syn
     :param std_score_dict: standard scores indexed by neuron pair
     :param structural_delay_dict: (optional) axonal delays indexed by neuron pair
     :param minimal_synapse_delay: (optional) time lag must be larger than this synapse delay (and axonal delay)
+    :param kind: (optional) kind of peaks, see PEAK_KINDS, default: 'forward'
     :return: all_score_max: standard score index py neuron pair
      all_timelag_max: time lags indexed by neuron pair
      z_thr: threshold for standard score
     """
-    # TODO Implement reverse directions, that is looking for peaks at pre-synaptic spike time lags
-    # TODO Implement detection of negative peaks (inhibitory connections)
-
     if structural_delay_dict is None:
-        pairs = std_score_dict
-        offset = lambda pair: 0
+        pairs, std_score = stack_standardscores(std_score_dict)
+        offsets = None
     else:  # consider axonal delays
-        pairs = structural_delay_dict
-        offset = lambda pair: structural_delay_dict[pair]
+        pairs, std_score = stack_standardscores(std_score_dict, pairs=structural_delay_dict)
+        offsets = [structural_delay_dict[pair] for pair in pairs]
+    if len(pairs) == 0: std_score = np.zeros((0, len(timelags)))
 
-    # first, collect all z values and determine threshold
-    z_values = list()
-    for pair in pairs:
-        use = timelags > offset(pair)
-        if pair in std_score_dict:
-            std_score = std_score_dict[pair]
-            z_values += list(std_score[use])
-    z_thr = BH_threshold(z_values)
-
-    # second, determine peak z value and check if above threshold
-    all_score_max, all_timelag_max = [], []
-    for pair in pairs:
-        use = timelags > offset(pair) + minimal_synapse_delay
-        if pair in std_score_dict:
-            std_score = std_score_dict[pair]
-        try:
-            index_max = np.argmax(std_score[use])
-            timelag_max = timelags[use][index_max]
-            score_max = std_score[use][index_max]
-        except ValueError:  # ValueError: attempt to get argmax of an empty sequence
-            score_max = 0
-        if score_max > z_thr:   # looking at positive peaks only
-            all_score_max.append((pair, score_max))
-            all_timelag_max.append((pair, timelag_max))
-            logging.info(("Timeseries %d->%d" % pair) +
-                         (": max z = %f at %f s" % (score_max, timelag_max)))
-        else:
-            logging.info(("Timeseries %d->%d" % pair) + ': no peak (above threshold)')
+    z_thr, peaks = all_peaks_array(timelags, std_score, offsets=offsets, minimal_synapse_delay=minimal_synapse_delay,
+                                   kinds=(kind,))
+    score_max, timelag_max, significant = peaks[kind]
+    significant = np.flatnonzero(significant)
+    all_score_max = dict((pairs[i], score_max[i]) for i in significant)
+    all_timelag_max = dict((pairs[i], timelag_max[i]) for i in significant)
 
     logging.info('FDR correction %d --> %d with z>%f' % (len(std_score_dict), len(all_score_max), z_thr))
 
-    return dict(all_score_max), dict(all_timelag_max), z_thr
+    return all_score_max, all_timelag_max, z_thr
 
 
-def BH_threshold(z_values):
+def BH_threshold_by_fdrcorrection(z_values):
     """
     Threshold for standard scores by the Benjamini-Hochberg procedure.
     :param z_values: standard scores
@@ -200,3 +1226,39 @@ def BH_threshold(z_values):
     z_thr = min(abs_z_values[rejected == True])
     return z_thr
 
+
+def BH_threshold_by_selection(z_values, chunk_size=2**22):
+    """
+    Threshold for standard scores by the Benjamini-Hochberg procedure, same as BH_threshold_by_fdrcorrection, but
+    without sorting all standard scores. With the false discovery rate alpha = 1/m for m standard scores, only those
+    with p <= alpha can be rejected, that is abs(z) >= sqrt(2) * erfcinv(1/m). These candidates are selected chunk by
+    chunk, and only they are sorted. Much faster and less memory for millions of standard scores, which could be
+    float32 and could be given as several shards that are not concatenated.
+    :param z_values: standard scores, or a list of arrays (shards) of standard scores
+    :param chunk_size: number of standard scores processed at once
+    :return: z_threshold: for absolute value of the standard scores, that is abs(z)>z_threshold
+    """
+    if isinstance(z_values, (list, tuple)) and len(z_values) > 0 and np.ndim(z_values[0]) > 0:
+        shards = [np.ravel(shard) for shard in z_values]
+    else:
+        shards = [np.ravel(z_values)]
+    m = sum(shard.size for shard in shards)
+    if m == 0:
+        raise ValueError('No standard scores for Benjamini-Hochberg procedure')
+    FDR = 1 / m
+    z_min = np.sqrt(2) * erfcinv(FDR) * (1 - 1e-6)  # margin for rounding, candidates are checked again below
+    candidates = []
+    for shard in shards:
+        for begin in range(0, shard.size, chunk_size):
+            abs_z_values = np.abs(shard[begin:begin + chunk_size])
+            candidates.append(abs_z_values[abs_z_values >= z_min])
+    abs_z_values = -np.sort(-np.hstack(candidates).astype(np.float64))  # largest first, that is smallest p first
+    p_values = erfc(abs_z_values / np.sqrt(2))
+    rejected = np.flatnonzero(p_values <= np.arange(1, len(p_values) + 1) / m * FDR)
+    if len(rejected) == 0:
+        raise ValueError('No standard score rejected by Benjamini-Hochberg procedure')
+    z_thr = abs_z_values[rejected[-1]]
+    return z_thr
+
+
+BH_threshold = BH_threshold_by_selection
@@ -0,0 +1,88 @@
+"""
+Helpers for running sharded computations in a process pool.
+
+Large arrays (e.g. all spike times) are written once to memory mapped .npy files in a temporary directory. Only the
+name of that directory is send with each task, and each worker process maps the arrays once and reuses them for all
+shards it processes.
+"""
+
+import os
+import multiprocessing
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class SharedArrays:
+    """
+    Context manager writing arrays to memory mapped files, which can be opened by worker processes with shared_arrays.
+    Usage:
+        with SharedArrays(times=times, offsets=offsets) as directory:
+            results = map_shards(worker, [(directory, begin, end) for begin, end in shards(n, 10)], workers=4)
+    """
+
+    def __init__(self, directory=None, **arrays):
+        self.arrays = arrays
+        self.parent_directory = directory
+        self.directory = None
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix='hana_', dir=self.parent_directory)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(self.directory, name + '.npy'), np.ascontiguousarray(array))
+        logging.info('Shared %d arrays in %s' % (len(self.arrays), self.directory))
+        return self.directory
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+
+
+_shared_arrays_cache = {}
+
+
+def shared_arrays(directory):
+    """
+    Open the arrays written by SharedArrays as read-only memory maps. The arrays are opened once per process.
+    :param directory: see SharedArrays
+    :return: dictionary of arrays indexed by name
+    """
+    if directory not in _shared_arrays_cache:
+        _shared_arrays_cache.clear()  # only keep the arrays of the current computation
+        _shared_arrays_cache[directory] = {name[:-len('.npy')]: np.load(os.path.join(directory, name), mmap_mode='r')
+                                           for name in os.listdir(directory) if name.endswith('.npy')}
+    return _shared_arrays_cache[directory]
+
+
+def shards(n, shard_n):
+    """
+    Split range(n) into (at most) shard_n contiguous shards of similar size.
+    :return: list of (begin, end) tuples
+    """
+    bounds = np.linspace(0, n, min(shard_n, n) + 1).astype(int)
+    return [(begin, end) for begin, end in zip(bounds[:-1], bounds[1:])]
+
+
+def map_shards(function, tasks, workers=1):
+    """
+    Apply function to each task (a tuple of arguments), either serially or in a process pool.
+    :param function: module level function (must be picklable)
+    :param tasks: list of argument tuples
+    :param workers: number of worker processes; 1: serial execution, None: all cores
+    :return: list of results in the order of the tasks
+    """
+    if workers == 1 or len(tasks) < 2:
+        return [function(*task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(function, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def shard_n_for(workers, per_worker=4):
+    """Number of shards for load balancing, that is a few shards per worker process."""
+    return per_worker * (workers if workers is not None else multiprocessing.cpu_count())
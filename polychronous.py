@@ -1,61 +1,246 @@
+from hana.function import SurrogateTimeseries
 from hana.misc import unique_neurons
+from hana.parallel import SharedArrays, shared_arrays, shard_n_for, map_shards
+from hana.spiketrains import SpikeTrains, as_spiketrains
 from hana.plotting import plot_neuron_points, plot_network, highlight_connection, mea_axes
 
+import h5py
 import numpy as np
 import networkx as nx
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from matplotlib import pyplot as plt
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
+# record for each pair of connected events, 24 bytes
+CONNECTED_EVENTS_DTYPE = np.dtype([('pre_time', 'f8'), ('pre', 'i4'), ('post_time', 'f8'), ('post', 'i4')])
+# record for each event, sorted by time and neuron
+EVENTS_DTYPE = np.dtype([('time', 'f8'), ('neuron', 'i4')])
 
-def filter(timeseries, axonal_delays, additional_synaptic_delay=0.001, synaptic_jitter=0.001):
+
+def filter(timeseries, axonal_delays, additional_synaptic_delay=0.001, synaptic_jitter=0.001, workers=1,
+           matcher='pairs'):
     """
     Shift presynaptic spike by timelag predicted from axonal and synaptic delay. Shifted presynaptic spikes and
     post synaptic spikes that match timing within a jitter form pairs of pre- and post-synaptic events, which could
     be the result of a synaptic transmission. See Izhekevich, 2006 for further explanation.
-    :param timeseries: dict of neuron_id: vector of time
+    If the time series are SpikeTrains storing sample indices, the predicted time lags are rounded to whole samples
+    and the spikes are matched in samples, that is by integer arithmetic.
+    :param timeseries: dict of neuron_id: vector of time, or SpikeTrains
     :param axonal_delays: dict of (pre_neuron_id, post_neuron_id): axonal_delay in ms(!)
     :param additional_synaptic_delay: single value, in s(!)
     :param synaptic_jitter: single value, representing maximum allowed synaptic jitter (+/-), in s(!)
-    :return: connected_events: tupels (time, pre_neuron_id), (time, post_neuron_id)
+    :param workers: number of worker processes (None: all cores), see parallel.map_shards; if not 1, the recording
+    is cut into time shards, see _filter_shard, and the result is the same as for a serial run
+    :param matcher: 'pairs': search the postsynaptic spike train for each pair separately (_connected_event_chunks),
+    'sweep': match all pairs in one sweep over the merged and sorted spikes and queries (_sweep_connected_event_chunks);
+    both find the same connected events in the same order
+    :return: connected_events: structured array with fields pre_time, pre, post_time, post (times in s), see
+    CONNECTED_EVENTS_DTYPE and as_tuples for the former list of tupels (time, pre_neuron_id), (time, post_neuron_id)
     """
     # TODO: Improve function description, remove unit inconsistencies (ms vs. s)
-    connected_events = []
-    for pre, post in axonal_delays:
-        time_lag = (axonal_delays[pre, post])/1000 + additional_synaptic_delay  # axonal delays in ms -> events in s
+    delays = [(pre, post, axonal_delays[pre, post]) for pre, post in axonal_delays]
+    if workers == 1:
+        chunks = [events for _, events in MATCHERS[matcher](
+            timeseries, timeseries, delays, additional_synaptic_delay, synaptic_jitter)]
+    else:
+        chunks = _sharded_connected_event_chunks(timeseries, delays, additional_synaptic_delay, synaptic_jitter,
+                                                 workers, matcher=matcher)
+    connected_events = np.concatenate(chunks) if len(chunks) > 0 else np.zeros(0, dtype=CONNECTED_EVENTS_DTYPE)
+    logging.info("Total %d pairs" % len(connected_events))
+    return connected_events
+
+
+def _connected_event_chunks(presynaptic, postsynaptic, delays, additional_synaptic_delay, synaptic_jitter):
+    """
+    Connected events for each pair and direction, see filter. Presynaptic and postsynaptic spikes could be taken from
+    different (parts of the) time series.
+    :param presynaptic, postsynaptic: dict of neuron_id: vector of time, or SpikeTrains
+    :param delays: list of (pre_neuron_id, post_neuron_id, axonal_delay)
+    :return: list of ((pair index, offset), connected events)
+    """
+    sampling_rate = getattr(presynaptic, 'sampling_rate', None)
+    chunks = []
+    event_n = 0
+    for index, (pre, post, axonal_delay) in enumerate(delays):
+        time_lag = axonal_delay/1000 + additional_synaptic_delay  # axonal delays in ms -> events in s
         logging.info("Finding spike pairs %d -> %d with predicted spike time lag %f s:" % (pre, post, time_lag))
 
-        if (pre in timeseries) and (post in timeseries):
-            presynaptic_spikes = timeseries[pre]
-            shifted_presynaptic_spikes = presynaptic_spikes+time_lag
-            postsynaptic_spikes = timeseries[post]
-            postsynaptic_spikes = np.hstack((-np.inf, postsynaptic_spikes, np.inf))  # padding to keep position within
+        if (pre in presynaptic) and (post in postsynaptic):
+            if sampling_rate is None:
+                presynaptic_spikes, postsynaptic_spikes = presynaptic[pre], postsynaptic[post]
+                shift, jitter = time_lag, synaptic_jitter
+            else:  # sample indices
+                presynaptic_spikes, postsynaptic_spikes = presynaptic.ticks(pre), postsynaptic.ticks(post)
+                shift, jitter = int(round(time_lag * sampling_rate)), synaptic_jitter * sampling_rate
+            if len(postsynaptic_spikes) == 0: continue
+            shifted_presynaptic_spikes = presynaptic_spikes + shift
             for offset in (0, 1):  # checking postsynaptic spike before and after shifted presynaptic spike
-                position = (np.searchsorted(postsynaptic_spikes, shifted_presynaptic_spikes) - offset).\
-                    clip(0, len(postsynaptic_spikes) - 1)
-                valid = np.abs(shifted_presynaptic_spikes - postsynaptic_spikes[position]) < synaptic_jitter
+                position = np.searchsorted(postsynaptic_spikes, shifted_presynaptic_spikes) - offset
+                inside = (position >= 0) & (position < len(postsynaptic_spikes))
+                position = position.clip(0, len(postsynaptic_spikes) - 1)
+                valid = inside & (np.abs(shifted_presynaptic_spikes - postsynaptic_spikes[position]) < jitter)
                 valid_presynaptic_spikes = presynaptic_spikes[valid]
                 valid_postsynaptic_spikes = postsynaptic_spikes[position[valid]]
-                new_connected_events = [((pre_time, pre), (post_time, post))
-                                        for pre_time, post_time
-                                        in (zip(valid_presynaptic_spikes, valid_postsynaptic_spikes))]
+                if sampling_rate is not None:
+                    valid_presynaptic_spikes = presynaptic.to_seconds(valid_presynaptic_spikes)
+                    valid_postsynaptic_spikes = presynaptic.to_seconds(valid_postsynaptic_spikes)
+                new_connected_events = np.empty(len(valid_presynaptic_spikes), dtype=CONNECTED_EVENTS_DTYPE)
+                new_connected_events['pre_time'] = valid_presynaptic_spikes
+                new_connected_events['pre'] = pre
+                new_connected_events['post_time'] = valid_postsynaptic_spikes
+                new_connected_events['post'] = post
                 logging.info("From %d candidates add %d valid to %d existing pairs"
-                             % (len(position), len(new_connected_events), len(connected_events)))
-                connected_events = connected_events + new_connected_events
+                             % (len(position), len(new_connected_events), event_n))
+                chunks.append(((index, offset), new_connected_events))
+                event_n += len(new_connected_events)
+    return chunks
 
-    logging.info("Total %d pairs" % len(connected_events))
-    return connected_events
+
+def _sharded_connected_event_chunks(timeseries, delays, additional_synaptic_delay, synaptic_jitter, workers,
+                                    matcher='pairs'):
+    """
+    Connected events computed in time shards by worker processes, see filter. Each shard owns the connected events
+    whose presynaptic spike is within its time window, and sees the postsynaptic spikes within a margin of the
+    largest predicted time lag plus the jitter around that window. Therefore, the (preceding and succeeding)
+    postsynaptic spikes matched to each presynaptic spike are the same as for all spikes, and each connected event is
+    found by exactly one shard. The chunks are merged in the order of a serial run.
+    """
+    trains = as_spiketrains(timeseries)
+    if len(delays) == 0 or np.sum(trains.counts()) == 0: return []
+    margin = max(abs(axonal_delay/1000 + additional_synaptic_delay) for _, _, axonal_delay in delays) + \
+        synaptic_jitter
+    if trains.sampling_rate is not None: margin += 1 / trains.sampling_rate  # rounding of time lags to samples
+    begin, end = trains.interval()
+    edges = np.linspace(begin, end, shard_n_for(workers) + 1)
+    edges[0], edges[-1] = -np.inf, np.inf
+    with SharedArrays(**trains.arrays()) as directory:
+        tasks = [(directory, shard_begin, shard_end, margin, delays, additional_synaptic_delay, synaptic_jitter,
+                  matcher) for shard_begin, shard_end in zip(edges[:-1], edges[1:])]
+        results = map_shards(_filter_shard, tasks, workers=workers)
+    merged = dict()
+    for shard_chunks in results:  # shards in order of time
+        for key, events in shard_chunks:
+            merged.setdefault(key, []).append(events)
+    return [np.concatenate(merged[key]) for key in sorted(merged)]
+
+
+def _filter_shard(directory, begin, end, margin, delays, additional_synaptic_delay, synaptic_jitter, matcher='pairs'):
+    """Worker for _sharded_connected_event_chunks, finding the connected events for presynaptic spikes within
+    [begin, end)."""
+    trains = SpikeTrains.from_arrays(shared_arrays(directory))
+    return MATCHERS[matcher](trains.window(begin, end), trains.window(begin - margin, end + margin), delays,
+                             additional_synaptic_delay, synaptic_jitter)
+
+
+def _sweep_connected_event_chunks(presynaptic, postsynaptic, delays, additional_synaptic_delay, synaptic_jitter,
+                                  batch_size=2**22):
+    """
+    Connected events for all pairs at once, same as _connected_event_chunks: The presynaptic spikes shifted by the
+    predicted time lag of each pair (queries) are labeled by the pair's postsynaptic neuron and merged into the stream
+    of all postsynaptic spikes, which is sorted by (neuron, time). As the queries are grouped by their label, the merge
+    takes one search per postsynaptic neuron (instead of one per pair), and the preceding and succeeding spikes of
+    each query are its neighbours in the merged stream, if they have the same label. Pairs are processed in batches
+    of about batch_size queries to limit memory.
+    :param presynaptic, postsynaptic: dict of neuron_id: vector of time, or SpikeTrains
+    :param delays: list of (pre_neuron_id, post_neuron_id, axonal_delay)
+    :return: list of ((pair index, offset), connected events)
+    """
+    presynaptic, postsynaptic = as_spiketrains(presynaptic), as_spiketrains(postsynaptic)
+    sampling_rate = presynaptic.sampling_rate
+    jitter = synaptic_jitter if sampling_rate is None else synaptic_jitter * sampling_rate  # sample indices
+    spikes, offsets = postsynaptic.concatenated(seconds=False)
+    queries = []
+    for index, (pre, post, axonal_delay) in enumerate(delays):
+        if (pre not in presynaptic) or (post not in postsynaptic): continue
+        i, j = presynaptic.index[pre], postsynaptic.index[post]
+        if presynaptic.starts[i] == presynaptic.stops[i] or offsets[j] == offsets[j + 1]: continue
+        time_lag = axonal_delay/1000 + additional_synaptic_delay  # axonal delays in ms -> events in s
+        shift = time_lag if sampling_rate is None else int(round(time_lag * sampling_rate))
+        queries.append((j, index, presynaptic.data[presynaptic.starts[i]:presynaptic.stops[i]], shift, pre, post))
+    queries.sort(key=lambda query: query[:2])  # grouped by label
+    batch, query_n, chunks = [], 0, []
+    for query in queries:
+        batch.append(query)
+        query_n += len(query[2])
+        if query_n >= batch_size:
+            chunks += _sweep_batch(batch, spikes, offsets, jitter, presynaptic)
+            batch, query_n = [], 0
+    if len(batch) > 0: chunks += _sweep_batch(batch, spikes, offsets, jitter, presynaptic)
+    chunks.sort(key=lambda chunk: chunk[0])  # in order of the pairs
+    return chunks
+
+
+def _sweep_batch(batch, spikes, offsets, jitter, trains):
+    """Matching of a batch of queries grouped by label, see _sweep_connected_event_chunks."""
+    if sum(len(presynaptic_spikes) for _, _, presynaptic_spikes, _, _, _ in batch) == 0: return []
+    counts = np.array([len(presynaptic_spikes) for _, _, presynaptic_spikes, _, _, _ in batch], dtype=np.int64)
+    query_pair = np.repeat(np.arange(len(batch)), counts)
+    presynaptic_spikes = np.concatenate([presynaptic_spikes for _, _, presynaptic_spikes, _, _, _ in batch])
+    shifted = presynaptic_spikes + np.repeat([shift for _, _, _, shift, _, _ in batch], counts)
+    labels = np.repeat([j for j, _, _, _, _, _ in batch], counts)
+    bounds = np.flatnonzero(np.diff(labels)) + 1
+    position = np.empty(len(shifted), dtype=np.int64)  # of the first spike not before the query
+    for begin, end in zip(np.hstack((0, bounds)), np.hstack((bounds, len(labels)))):
+        j = labels[begin]
+        position[begin:end] = offsets[j] + np.searchsorted(spikes[offsets[j]:offsets[j + 1]], shifted[begin:end])
+    logging.info('Merging %d queries of %d pairs into %d spikes' % (len(shifted), len(batch), len(spikes)))
+    found = []
+    for offset in (0, 1):  # succeeding and preceding spike, as in _connected_event_chunks
+        neighbour = position - offset
+        inside = (neighbour >= offsets[labels]) & (neighbour < offsets[labels + 1])
+        neighbour = np.where(inside, neighbour, 0)
+        valid = inside & (np.abs(shifted - spikes[neighbour]) < jitter)
+        query_index = np.flatnonzero(valid)
+        found.append((query_index, query_pair[query_index] * 2 + offset, neighbour[query_index]))
+    query_index, key, spike_index = [np.concatenate(arrays) for arrays in zip(*found)]
+    found_order = np.lexsort((query_index, key))  # in order of the presynaptic spikes for each pair and offset
+    query_index, key, spike_index = query_index[found_order], key[found_order], spike_index[found_order]
+    events = np.empty(len(key), dtype=CONNECTED_EVENTS_DTYPE)
+    events['pre_time'] = trains.to_seconds(presynaptic_spikes[query_index])
+    events['pre'] = np.array([pre for _, _, _, _, pre, _ in batch])[key // 2]
+    events['post_time'] = trains.to_seconds(spikes[spike_index])
+    events['post'] = np.array([post for _, _, _, _, _, post in batch])[key // 2]
+    keys, starts = np.unique(key, return_index=True)
+    return [((batch[k // 2][1], k % 2), events[start:stop])
+            for k, start, stop in zip(keys.tolist(), starts, np.hstack((starts[1:], len(key))))]
+
+
+MATCHERS = {'pairs': _connected_event_chunks, 'sweep': _sweep_connected_event_chunks}
+
+
+def as_tuples(connected_events):
+    """
+    Convert connected events into the former list of tupels.
+    :param connected_events: structured array, see polychronous.filter, or list of tupels
+    :return: list of tupels ((pre_time, pre_neuron_id), (post_time, post_neuron_id))
+    """
+    if not isinstance(connected_events, np.ndarray): return connected_events
+    return [((pre_time, pre), (post_time, post)) for pre_time, pre, post_time, post in connected_events.tolist()]
+
+
+def as_array(connected_events):
+    """
+    Convert connected events from the former list of tupels into a structured array, see polychronous.filter.
+    :param connected_events: list of tupels ((pre_time, pre_neuron_id), (post_time, post_neuron_id)), or structured
+    array
+    :return: structured array with fields pre_time, pre, post_time, post
+    """
+    if isinstance(connected_events, np.ndarray): return connected_events
+    return np.array([(pre_time, pre, post_time, post) for (pre_time, pre), (post_time, post) in connected_events],
+                    dtype=CONNECTED_EVENTS_DTYPE)
 
 
 def combine(connected_events):
     """
     Combine connected events into a graph.
-    :param connected_events: see polychronous.filter
+    :param connected_events: see polychronous.filter, structured array or list of tupels
     :return: graph_of_connected_events
     """
     graph_of_connected_events = nx.Graph()
-    graph_of_connected_events.add_edges_from(connected_events)
+    graph_of_connected_events.add_edges_from(as_tuples(connected_events))
     return (graph_of_connected_events)
 
 
@@ -80,10 +265,54 @@ def group(graph_of_connected_events):
     :param graph_of_connected_events: see polychronous.combine
     :return: list_of_polychronous_groups
     """
-    list_of_polychronous_groups = list(nx.connected_component_subgraphs(graph_of_connected_events))
+    list_of_polychronous_groups = [graph_of_connected_events.subgraph(component).copy()
+                                   for component in nx.connected_components(graph_of_connected_events)]
     return list_of_polychronous_groups
 
 
+class PolychronousGroups(object):
+    """
+    Polychronous groups as connected components of the connected events, without building a graph of all events:
+    Each event (time, neuron) gets an integer id, and the connected components are found on the sparse adjacency
+    matrix of these ids (scipy.sparse.csgraph). The groups are numbered in the order of their first event, and a
+    graph is only built for a group on request.
+    """
+
+    def __init__(self, connected_events):
+        """
+        :param connected_events: see polychronous.filter, structured array or list of tupels
+        """
+        self.connected_events = as_array(connected_events)
+        pre_events = np.empty(len(self.connected_events), dtype=EVENTS_DTYPE)
+        pre_events['time'], pre_events['neuron'] = self.connected_events['pre_time'], self.connected_events['pre']
+        post_events = np.empty(len(self.connected_events), dtype=EVENTS_DTYPE)
+        post_events['time'], post_events['neuron'] = self.connected_events['post_time'], self.connected_events['post']
+        self.events, ids = np.unique(np.concatenate((pre_events, post_events)), return_inverse=True)
+        ids = ids.ravel()
+        pre_ids, post_ids = ids[:len(pre_events)], ids[len(pre_events):]
+        adjacency = coo_matrix((np.ones(len(pre_ids), dtype=np.int8), (pre_ids, post_ids)),
+                               shape=(len(self.events), len(self.events)))
+        group_n, self.labels = connected_components(adjacency, directed=False)
+        self.sizes = np.bincount(self.labels, minlength=group_n)
+        self.edge_labels = self.labels[pre_ids]
+        logging.info('Data: %d events form %d pairs and %d polychronous groups'
+                     % (len(self.events), len(self.connected_events), group_n))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def graph(self, label):
+        """Graph of the connected events of one polychronous group, see polychronous.combine."""
+        return combine(self.connected_events[self.edge_labels == label])
+
+    def graphs(self):
+        """Graphs of all polychronous groups, one at a time."""
+        order = np.argsort(self.edge_labels, kind='stable')
+        bounds = np.hstack((0, np.cumsum(np.bincount(self.edge_labels, minlength=len(self)))))
+        for label in range(len(self)):
+            yield combine(self.connected_events[order[bounds[label]:bounds[label + 1]]])
+
+
 def shuffle_keys(dictionary):
     """
     Preparing surrogate data for polychronous.filter.
@@ -145,7 +374,7 @@ def plot_pcgs(ax, list_of_polychronous_groups):
         plot_pcg(ax, g, color=cycol())
 
 
-def shuffle_network(network, method='shuffle in-nodes'):
+def shuffle_network(network, method='shuffle in-nodes', random_state=np.random):
     """
     Shuffling the network.
 
@@ -158,21 +387,22 @@ def shuffle_network(network, method='shuffle in-nodes'):
     :param method:  all methods have the same result:
                     'shuffle in-nodes': shuffle the connected nodes, keeping the in- and out-connectivity
                     'shuffle values': shuffle the connected nodes, keeping the in- and out-connectivity
+    :param random_state: (optional) numpy.random.RandomState for reproducible shuffles, default: global random state
 
     :return:
     """
-    vertices = network.keys()
-    values = network.values()
+    vertices = list(network.keys())
+    values = list(network.values())
 
     if method == 'shuffle values':
         logging.info('Shuffle values..')
-        np.random.shuffle(values)
+        random_state.shuffle(values)
 
     if method == 'shuffle in-nodes':
         logging.info('Shuffle in-nodes..')
         out_nodes, in_nodes = zip(*vertices)
         new_in_nodes = list(in_nodes)
-        np.random.shuffle(new_in_nodes)
+        random_state.shuffle(new_in_nodes)
         vertices = zip(out_nodes, new_in_nodes)
 
     new_network = dict(zip(vertices, values))
@@ -181,10 +411,215 @@ def shuffle_network(network, method='shuffle in-nodes'):
 
 
 def extract_pcgs(connected_events):
-    graph_of_connected_events = combine(connected_events)
-    logging.info('Data: %d events form %d pairs'
-                 % (len(graph_of_connected_events.nodes()), len(graph_of_connected_events.edges())))
-    list_of_polychronous_groups = group(graph_of_connected_events)
+    """
+    Extract polychronous groups, see PolychronousGroups.
+    :param connected_events: see polychronous.filter
+    :return: list_of_polychronous_groups: graph for each group
+             polychronous_group_size: number of events in each group
+    """
+    groups = PolychronousGroups(connected_events)
+    list_of_polychronous_groups = list(groups.graphs())
     logging.info('Data: Forming %d polycronous groups' % len(list_of_polychronous_groups))
-    polychronous_group_size = list(len(g) for g in list_of_polychronous_groups)
-    return list_of_polychronous_groups, polychronous_group_size
\ No newline at end of file
+    polychronous_group_size = groups.sizes.tolist()
+    return list_of_polychronous_groups, polychronous_group_size
+
+
+def extract_pcg_sizes(connected_events):
+    """Sizes (number of events) of the polychronous groups, without building their graphs, see extract_pcgs."""
+    return PolychronousGroups(connected_events).sizes.tolist()
+
+def stream_pcgs(timeseries, axonal_delays, sink, additional_synaptic_delay=0.001, synaptic_jitter=0.001,
+                chunk_duration=10.0, matcher='pairs'):
+    """
+    Extract polychronous groups by sweeping the recording in time order, with bounded memory: The connected events
+    (see filter) are found for the presynaptic spikes in one chunk of time after the other. Groups stay open as long
+    as their latest event is within the largest predicted time lag plus jitter of the sweep front, because only then
+    they could be joined by connected events of later chunks. All other groups are complete and are passed to the sink
+    and dropped. Memory therefore depends on the number of concurrently open groups and the chunk duration, not on
+    the length of the recording. The groups are the same as for extract_pcgs on the connected events of all spikes.
+    :param timeseries: dict of neuron_id: vector of time, SpikeTrains, or recording.EventsFile, which is read chunk by
+    chunk
+    :param axonal_delays: dict of (pre_neuron_id, post_neuron_id): axonal_delay in ms(!)
+    :param sink: called with (connected_events, size) for each completed group, in the order of its completion, e.g.
+    a PolychronousGroupsFile
+    :param additional_synaptic_delay, synaptic_jitter: see filter
+    :param chunk_duration: duration (in s) of each sweep step
+    :param matcher: see filter
+    :return: number of polychronous groups
+    """
+    delays = [(pre, post, axonal_delays[pre, post]) for pre, post in axonal_delays]
+    if len(delays) == 0 or len(timeseries) == 0: return 0
+    if not hasattr(timeseries, 'chunks'): timeseries = as_spiketrains(timeseries)
+    counts = timeseries.counts()  # array for SpikeTrains, dictionary for an EventsFile
+    if np.sum(list(counts.values()) if isinstance(counts, dict) else counts) == 0: return 0
+    margin = max(abs(axonal_delay/1000 + additional_synaptic_delay) for _, _, axonal_delay in delays) + \
+        synaptic_jitter
+    if getattr(timeseries, 'sampling_rate', None) is not None: margin += 1 / timeseries.sampling_rate
+    begin, end = timeseries.interval()
+    open_events = np.zeros(0, dtype=CONNECTED_EVENTS_DTYPE)
+    group_n = 0
+    for i in range(int((end - begin) // chunk_duration) + 1):
+        chunk_begin, chunk_end = begin + i * chunk_duration, begin + (i + 1) * chunk_duration
+        postsynaptic = _spiketrains_within(timeseries, chunk_begin - margin, chunk_end + margin)
+        presynaptic = postsynaptic.window(chunk_begin, chunk_end)
+        chunks = [events for _, events in MATCHERS[matcher](
+            presynaptic, postsynaptic, delays, additional_synaptic_delay, synaptic_jitter)]
+        open_events = np.concatenate([open_events] + chunks)
+        # connected events of later chunks only contain events after chunk_end - margin
+        open_events, closed_n = _close_groups(open_events, chunk_end - margin, sink)
+        group_n += closed_n
+    _, closed_n = _close_groups(open_events, np.inf, sink)
+    group_n += closed_n
+    logging.info('Streamed %d polychronous groups' % group_n)
+    return group_n
+
+
+def _spiketrains_within(timeseries, begin, end):
+    """Spike trains within [begin, end) of in-memory SpikeTrains or of a recording.EventsFile."""
+    if isinstance(timeseries, SpikeTrains): return timeseries.window(begin, end)
+    return SpikeTrains.from_dict(timeseries.timeseries(begin, end))
+
+
+def _close_groups(connected_events, front, sink):
+    """
+    Pass the groups of connected events, whose latest event is before the front, to the sink, see stream_pcgs.
+    :return: connected events of the groups still open, number of closed groups
+    """
+    if len(connected_events) == 0: return connected_events, 0
+    groups = PolychronousGroups(connected_events)
+    latest = np.full(len(groups), -np.inf)
+    np.maximum.at(latest, groups.labels, groups.events['time'])
+    closed = latest < front
+    for label in np.flatnonzero(closed):  # in order of the first event of each group
+        sink(groups.connected_events[groups.edge_labels == label], groups.sizes[label])
+    return groups.connected_events[~closed[groups.edge_labels]], np.count_nonzero(closed)
+
+
+class PolychronousGroupsFile(object):
+    """
+    Sink for stream_pcgs, appending the completed polychronous groups to a HDF5 file: the connected events of all
+    groups are stored as one dataset, the events of group i being connected_events[offsets[i]:offsets[i+1]], and the
+    sizes (number of events) of the groups as another.
+    Usage:
+        with PolychronousGroupsFile(filename) as pcgs_file:
+            stream_pcgs(timeseries, axonal_delays, pcgs_file)
+    """
+
+    def __init__(self, filename):
+        self.h5file = h5py.File(filename, 'w')
+        self.connected_events = self.h5file.create_dataset('connected_events', (0,), dtype=CONNECTED_EVENTS_DTYPE,
+                                                           maxshape=(None,), chunks=(4096,))
+        self.offsets = self.h5file.create_dataset('offsets', data=np.zeros(1, dtype=np.int64), maxshape=(None,),
+                                                  chunks=(4096,))
+        self.sizes = self.h5file.create_dataset('sizes', (0,), dtype=np.int64, maxshape=(None,), chunks=(4096,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.h5file.close()
+
+    def __call__(self, connected_events, size):
+        """Append one polychronous group."""
+        event_n, group_n = len(self.connected_events), len(self.sizes)
+        self.connected_events.resize((event_n + len(connected_events),))
+        self.connected_events[event_n:] = connected_events
+        self.offsets.resize((group_n + 2,))
+        self.offsets[group_n + 1] = event_n + len(connected_events)
+        self.sizes.resize((group_n + 1,))
+        self.sizes[group_n] = size
+
+
+def load_pcgs(filename):
+    """
+    Load the polychronous groups written by PolychronousGroupsFile.
+    :return: connected_events: structured array, see polychronous.filter
+             offsets: the connected events of group i are connected_events[offsets[i]:offsets[i+1]]
+             sizes: number of events in each group
+    """
+    with h5py.File(filename, 'r') as h5file:
+        return h5file['connected_events'][()], h5file['offsets'][()], h5file['sizes'][()]
+
+
+SURROGATE_METHODS = ('shuffle in-nodes', 'shuffle values', 'randomize intervals')
+
+
+def pcg_size_statistics(sizes, max_size=100, top=10):
+    """
+    Summary statistics of the sizes of polychronous groups, instead of the groups themselves.
+    :param sizes: number of events in each group, see extract_pcg_sizes
+    :param max_size: the histogram counts sizes up to max_size, with the last bin counting all larger groups
+    :param top: number of largest groups to keep
+    :return: dictionary with hist (number of groups by size), largest (sizes of the top largest groups, descending),
+             group_n (number of groups) and event_n (number of events in all groups)
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    return {'hist': np.bincount(np.minimum(sizes, max_size), minlength=max_size + 1),
+            'largest': np.sort(sizes)[::-1][:top],
+            'group_n': len(sizes),
+            'event_n': int(np.sum(sizes))}
+
+
+def surrogate_pcg_ensemble(timeseries, axonal_delays, n=10, methods=SURROGATE_METHODS, seed=0, workers=1,
+                           additional_synaptic_delay=0, synaptic_jitter=0.0005, max_size=100, top=10,
+                           confidence=0.95):
+    """
+    Distribution of polychronous group sizes for n replicates of each surrogate method, the replicates running in a
+    process pool. Each replicate draws from its own random stream, so the results do not depend on the number of
+    workers, and only keeps the summary statistics of its groups, see pcg_size_statistics.
+    :param timeseries: dict of neuron_id: vector of time, or SpikeTrains
+    :param axonal_delays: dict of (pre_neuron_id, post_neuron_id): axonal_delay in ms(!), see filter
+    :param n: number of replicates for each method
+    :param methods: 'shuffle in-nodes' and 'shuffle values': see shuffle_network, 'randomize intervals': surrogate
+    time series, see function.SurrogateTimeseries
+    :param seed: seed for all random streams
+    :param workers: number of worker processes (None: all cores), see parallel.map_shards
+    :param additional_synaptic_delay, synaptic_jitter: see filter
+    :param max_size, top: see pcg_size_statistics
+    :param confidence: confidence level of the bands
+    :return: dictionary indexed by method, of dictionaries with
+             hist: histograms of group size indexed by (replicate, size), see pcg_size_statistics
+             mean, lower, upper: mean and confidence band of the number of groups by size
+             largest: sizes of the largest groups indexed by (replicate, rank), padded with zeros
+             group_n, event_n: number of groups and events for each replicate
+    """
+    trains = as_spiketrains(timeseries)
+    with SharedArrays(**trains.arrays()) as directory:
+        tasks = [(directory, axonal_delays, method_index, method, replicate, seed, additional_synaptic_delay,
+                  synaptic_jitter, max_size, top) for method_index, method in enumerate(methods)
+                 for replicate in range(n)]
+        results = map_shards(_pcg_replicate, tasks, workers=workers)
+    ensemble = dict()
+    for method_index, method in enumerate(methods):
+        statistics = results[method_index * n:(method_index + 1) * n]
+        hist = np.array([replicate['hist'] for replicate in statistics])
+        largest = np.zeros((n, top), dtype=np.int64)
+        for replicate, replicate_statistics in enumerate(statistics):
+            largest[replicate, :len(replicate_statistics['largest'])] = replicate_statistics['largest']
+        ensemble[method] = {'hist': hist,
+                            'mean': hist.mean(axis=0),
+                            'lower': np.percentile(hist, 100 * (1 - confidence) / 2, axis=0),
+                            'upper': np.percentile(hist, 100 * (1 + confidence) / 2, axis=0),
+                            'largest': largest,
+                            'group_n': np.array([replicate['group_n'] for replicate in statistics]),
+                            'event_n': np.array([replicate['event_n'] for replicate in statistics])}
+    return ensemble
+
+
+def _pcg_replicate(directory, axonal_delays, method_index, method, replicate, seed, additional_synaptic_delay,
+                   synaptic_jitter, max_size, top):
+    """Worker for surrogate_pcg_ensemble, returning the summary statistics of one replicate."""
+    timeseries = SpikeTrains.from_arrays(shared_arrays(directory))
+    if method == 'randomize intervals':
+        timeseries = {neuron: timeseries[neuron] for neuron in timeseries if len(timeseries[neuron]) > 0}
+        surrogates = SurrogateTimeseries(timeseries, n=replicate + 1, factor=2, seed=seed)
+        timeseries = {neuron: surrogates.surrogate(neuron, replicate) for neuron in timeseries}
+    else:
+        random_state = np.random.RandomState([seed, method_index, replicate])
+        axonal_delays = shuffle_network(axonal_delays, method=method, random_state=random_state)
+    connected_events = filter(timeseries, axonal_delays, additional_synaptic_delay=additional_synaptic_delay,
+                              synaptic_jitter=synaptic_jitter)
+    return pcg_size_statistics(extract_pcg_sizes(connected_events), max_size=max_size, top=top)
@@ -1,5 +1,6 @@
-from hana.h5dict import load_dict_from_hdf5
+from hana.h5dict import load_dict_from_hdf5, maybe_convert_to_int, maybe_convert_to_string
 from hana.plotting import annotate_x_bar
+from hana.spiketrains import SpikeTrains
 
 import h5py
 import numpy as np
@@ -15,6 +16,7 @@ this_dir, this_filename = os.path.split(__file__)
 HIDENS_ELECTRODES_FILE = os.path.join(this_dir, 'hidens_electrodes.h5')
 HIDENS_MAXIMUM_NEIGHBORS = 7 # sanity check: there are 7 electrodes within 20um on hidens
 HIDENS_NEIGHBORHOOD_RADIUS = 20 # neighboring electrodes within 20um
+HIDENS_SAMPLING_RATE = 20000  # Hz
 DELAY_EPSILON = 0.050  # resolution for threshold in ms   TODO use nbins, eg. 4ms+4ms/0.05ms = 8 * 20 = 160
 
 
@@ -206,15 +208,149 @@ def load_traces(filename):
 def get_variable(file, key): return np.array(file[key] if key in file.keys() else None)
 
 
-def load_timeseries(filename, neurons='all'):
-    """Load time series as a dictionary indexed by neuron from hdf5 file"""
-    timeseries = load_dict_from_hdf5(filename)
-    # print(timeseries)
-    if neurons is not 'all':
-        timeseries = {neuron: timeseries[neuron] for neuron in neurons}
+def load_timeseries(filename, neurons='all', sampling_rate=None, dtype=np.int32):
+    """
+    Load time series as a dictionary indexed by neuron from hdf5 file. Only the requested neurons are read, see
+    EventsFile.
+    :param filename: path and name of the hdf5 file
+    :param neurons: (optional) neurons to load, default: 'all'
+    :param sampling_rate: (optional) e.g. HIDENS_SAMPLING_RATE, if given the spike times are stored as integer sample
+    indices in SpikeTrains, which still returns time series in s, but allows exact integer arithmetic for time lags
+    :param dtype: integer type for the sample indices, promoted to int64 if the recording exceeds its range, see
+    spiketrains.to_ticks
+    :return: time series indexed by neuron, dictionary or SpikeTrains
+    """
+    with EventsFile(filename, neurons=neurons) as events:
+        timeseries = events.timeseries()
+    if sampling_rate is not None:
+        timeseries = SpikeTrains.from_dict(timeseries, sampling_rate=sampling_rate, dtype=dtype)
     return timeseries
 
 
+def dataset_searchsorted(dataset, value, side='left', lo=0, hi=None, block=4096):
+    """
+    Binary search on a sorted one-dimensional HDF5 dataset, same as np.searchsorted but without reading the dataset:
+    the range is bisected by reading single values until it fits into one block, which is then read and searched.
+    :param dataset: h5py dataset (or array)
+    :param value: value to be inserted
+    :param side: 'left' or 'right', see np.searchsorted
+    :param lo, hi: (optional) search only within dataset[lo:hi]
+    :param block: number of values read at once
+    :return: index
+    """
+    if hi is None: hi = len(dataset)
+    while hi - lo > block:
+        middle = (lo + hi) // 2
+        if dataset[middle] < value or (side == 'right' and dataset[middle] == value):
+            lo = middle + 1
+        else:
+            hi = middle
+    return lo + int(np.searchsorted(dataset[lo:hi], value, side=side))
+
+
+class EventsFile(object):
+    """
+    Streaming access to the spike times in an events.h5 file, which contains one dataset of sorted spike times (in s)
+    for each neuron. Only the requested neurons are opened, and only the spikes within a time window, of a chunk or of
+    a single neuron are read, using binary searches on the datasets.
+    Usage:
+        with EventsFile(filename, neurons=neurons) as events:
+            for begin, end, chunk in events.chunks(600):
+                accumulator.add(chunk, end=end)
+    """
+
+    def __init__(self, filename, neurons='all'):
+        """
+        :param filename: path and name of the hdf5 file
+        :param neurons: (optional) neurons to read, default: 'all'
+        """
+        self.h5file = h5py.File(filename, 'r')
+        if isinstance(neurons, str) and neurons == 'all':
+            neurons = [maybe_convert_to_int(key) for key in self.h5file.keys()
+                       if isinstance(self.h5file[key], h5py.Dataset)]
+        self.datasets = dict((neuron, self.h5file[maybe_convert_to_string(neuron)]) for neuron in neurons)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.h5file.close()
+
+    def __iter__(self):
+        return iter(self.datasets)
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def __contains__(self, neuron):
+        return neuron in self.datasets
+
+    def __getitem__(self, neuron):
+        """All spike times of a neuron."""
+        return self.datasets[neuron][()]
+
+    def items(self):
+        """Iterate over neurons and their spike times, reading one neuron at a time."""
+        for neuron in self.datasets:
+            yield neuron, self[neuron]
+
+    def counts(self):
+        """Number of spikes for each neuron."""
+        return dict((neuron, len(dataset)) for neuron, dataset in self.datasets.items())
+
+    def interval(self):
+        """First and last spike time in s, reading only these."""
+        nonempty = [dataset for dataset in self.datasets.values() if len(dataset) > 0]
+        return min(dataset[0] for dataset in nonempty), max(dataset[-1] for dataset in nonempty)
+
+    def window(self, neuron, begin, end):
+        """Spike times of a neuron within [begin, end)."""
+        dataset = self.datasets[neuron]
+        first = dataset_searchsorted(dataset, begin)
+        return dataset[first:dataset_searchsorted(dataset, end, lo=first)]
+
+    def timeseries(self, begin=None, end=None):
+        """
+        Time series of all (requested) neurons, by default complete, otherwise within [begin, end).
+        :return: dictionary of time series indexed by neuron
+        """
+        if begin is None and end is None: return dict(self.items())
+        begin = -np.inf if begin is None else begin
+        end = np.inf if end is None else end
+        return dict((neuron, self.window(neuron, begin, end)) for neuron in self.datasets)
+
+    def chunks(self, duration, begin=None, end=None):
+        """
+        Iterate over consecutive chunks [begin + i * duration, begin + (i + 1) * duration) of the recording, by
+        default from the first to (including) the last spike. Each dataset is read sequentially from where the
+        previous chunk ended.
+        :param duration: duration of each chunk in s
+        :return: generator of (chunk_begin, chunk_end, dictionary of time series indexed by neuron)
+        """
+        if len(self.datasets) == 0 or all(len(dataset) == 0 for dataset in self.datasets.values()): return
+        first, last = self.interval()
+        begin = first if begin is None else begin
+        stops = dict((neuron, len(dataset)) for neuron, dataset in self.datasets.items())
+        if end is None:
+            end = last + duration  # at least one more chunk to include the last spike
+        else:
+            stops = dict((neuron, dataset_searchsorted(dataset, end)) for neuron, dataset in self.datasets.items())
+        positions = dict((neuron, dataset_searchsorted(dataset, begin)) for neuron, dataset in self.datasets.items())
+        chunk_begin = begin
+        while chunk_begin <= last and chunk_begin < end:
+            chunk_end = min(chunk_begin + duration, end)
+            chunk = dict()
+            for neuron, dataset in self.datasets.items():
+                stop = dataset_searchsorted(dataset, chunk_end, lo=positions[neuron], hi=stops[neuron])
+                chunk[neuron] = dataset[positions[neuron]:stop]
+                positions[neuron] = stop
+            yield chunk_begin, chunk_end, chunk
+            chunk_begin = chunk_end
+
+
 def load_positions(mea='hidens'):
     """Loads electrode positions"""
     if mea == 'hidens':
@@ -241,23 +377,57 @@ def average_electrode_area(pos, mea=None):
 
 
 def interval_of_timeseries (timeseries):
+    """First and last event of all (sorted) time series."""
     first, last = [], []
     for neuron in timeseries:
-        first.append(min(timeseries[neuron]))
-        last.append(max(timeseries[neuron]))
+        if len(timeseries[neuron]) > 0:
+            first.append(timeseries[neuron][0])
+            last.append(timeseries[neuron][-1])
     return min(first), max(last)
 
 
-def partial_timeseries (timeseries, interval=0.1):
+def partial_interval (timeseries, interval=0.1):
+    """
+    Time window for partial_timeseries.
+    :param timeseries: dictionary of time series indexed by neuron, SpikeTrains, or EventsFile (reading only the first
+    and last spikes)
+    :param interval: fraction of the recording from its beginning, or (begin, end) in s
+    :return: begin, end
+    """
+    if isinstance(interval, tuple): return interval
+    begin, end = timeseries.interval() if hasattr(timeseries, 'interval') else interval_of_timeseries(timeseries)
+    return begin, begin + (end - begin) * interval
 
-    begin, end = interval_of_timeseries(timeseries)
-    if interval is not tuple:
-        partial_begin, partial_end = (begin, begin + (end-begin) * interval)
-    else:
-        partial_begin, partial_end = interval
 
+def timeseries_windows (timeseries, windows):
+    """
+    Parts of the time series within several time windows [begin, end) as views, using one binary search on each
+    (sorted) time series for all windows. The time series are neither copied nor changed.
+    :param timeseries: dictionary of time series indexed by neuron, or SpikeTrains
+    :param windows: list of (begin, end) in s
+    :return: list of dictionaries (or SpikeTrains), one for each window
+    """
+    if isinstance(timeseries, SpikeTrains):
+        return [timeseries.window(begin, end) for begin, end in windows]
+    edges = np.array(windows, dtype=float).reshape(-1, 2)
+    parts = [dict() for window in windows]
     for neuron in timeseries:
-        timeseries[neuron] = timeseries[neuron][np.logical_and(timeseries[neuron]>partial_begin,timeseries[neuron]<partial_end)]
+        index = np.searchsorted(timeseries[neuron], edges, side='left')
+        for part, (first, stop) in zip(parts, index):
+            part[neuron] = timeseries[neuron][first:stop]
+    return parts
 
-    logging.info('Partial timeseries spanning %d~%d [s] of total %d~%d [s]' % (partial_begin, partial_end, begin, end))
-    return timeseries
+
+def partial_timeseries (timeseries, interval=0.1):
+    """
+    Part of the time series, as views without copying or changing the time series, see timeseries_windows.
+    :param timeseries: dictionary of time series indexed by neuron, or SpikeTrains
+    :param interval: fraction of the recording from its beginning (default: 0.1, first 10%), (begin, end) in s, or
+    list of (begin, end) for several windows
+    :return: time series within [begin, end), or a list of them for several windows
+    """
+    if isinstance(interval, list):
+        return timeseries_windows(timeseries, interval)
+    partial_begin, partial_end = partial_interval(timeseries, interval)
+    logging.info('Partial timeseries spanning %d~%d [s]' % (partial_begin, partial_end))
+    return timeseries_windows(timeseries, [(partial_begin, partial_end)])[0]
@@ -0,0 +1,193 @@
+"""
+Compact container for the spike trains of many neurons.
+
+All spike times are stored in one array, sorted by neuron and time, and each neuron's spike train is given by the
+index range starts[i]:stops[i]. Spike trains and time windows are therefore views into that array. Optionally, spike
+times are stored as integer sample indices (ticks) of the recording together with the sampling rate.
+"""
+
+import os
+from collections.abc import Mapping
+
+import h5py
+import numpy as np
+
+
+class SpikeTrains(Mapping):
+    """
+    Spike trains indexed by neuron, with the same (read-only) mapping interface as the dictionaries of time series used
+    throughout hana, that is spiketrains[neuron] is the vector of spike times (in s) of that neuron.
+    """
+
+    def __init__(self, data, starts, stops, neurons, sampling_rate=None):
+        """
+        :param data: spike times in s, or sample indices if a sampling rate is given
+        :param starts, stops: index range of each neuron's spike train in data
+        :param neurons: neuron indices
+        :param sampling_rate: (optional) sampling rate in Hz, if data contains sample indices
+        """
+        self.data = data
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.stops = np.asarray(stops, dtype=np.int64)
+        self.neurons = np.asarray(neurons)
+        self.sampling_rate = sampling_rate
+        self.index = dict((neuron, i) for i, neuron in enumerate(self.neurons.tolist()))
+
+    @classmethod
+    def from_dict(cls, timeseries, neurons=None, sampling_rate=None, dtype=np.int32):
+        """
+        Pack a dictionary of time series into spike trains.
+        :param timeseries: dictionary of time series (in s) indexed by neuron
+        :param neurons: (optional) neurons to include and their order, default: all
+        :param sampling_rate: (optional) if given, store the times as sample indices
+        :param dtype: integer type for the sample indices, int32 suffices for recordings up to 29.8 h at 20 kHz, and
+        is promoted to int64 for longer ones, see to_ticks
+        :return: SpikeTrains
+        """
+        if neurons is None: neurons = list(timeseries)
+        counts = np.array([len(timeseries[neuron]) for neuron in neurons], dtype=np.int64)
+        offsets = np.hstack((0, np.cumsum(counts)))
+        data = np.hstack([timeseries[neuron] for neuron in neurons]) if len(neurons) > 0 else np.zeros(0)
+        if sampling_rate is not None:
+            data = to_ticks(data, sampling_rate, dtype=dtype)
+        return cls(data, offsets[:-1], offsets[1:], neurons, sampling_rate=sampling_rate)
+
+    @classmethod
+    def from_list(cls, timeseries, sampling_rate=None, dtype=np.int32):
+        """Pack a list of time series into spike trains indexed by their position in the list."""
+        return cls.from_dict(dict(enumerate(timeseries)), neurons=range(len(timeseries)),
+                             sampling_rate=sampling_rate, dtype=dtype)
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        """Spike trains from the arrays returned by SpikeTrains.arrays, e.g. memory mapped by parallel.shared_arrays."""
+        offsets = arrays[prefix + 'offsets']
+        sampling_rate = arrays[prefix + 'sampling_rate'].item() if prefix + 'sampling_rate' in arrays else None
+        return cls(arrays[prefix + 'data'], offsets[:-1], offsets[1:], arrays[prefix + 'neurons'],
+                   sampling_rate=sampling_rate)
+
+    def __getitem__(self, neuron):
+        i = self.index[neuron]
+        return self.to_seconds(self.data[self.starts[i]:self.stops[i]])
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.neurons)
+
+    def __contains__(self, neuron):
+        return neuron in self.index
+
+    def ticks(self, neuron):
+        """Spike train of the neuron as sample indices."""
+        if self.sampling_rate is None: raise ValueError('Spike times are not stored as sample indices')
+        i = self.index[neuron]
+        return self.data[self.starts[i]:self.stops[i]]
+
+    def to_seconds(self, values):
+        """Convert values from the units of data into s."""
+        return values if self.sampling_rate is None else values / self.sampling_rate
+
+    def counts(self):
+        """Number of spikes for each neuron."""
+        return self.stops - self.starts
+
+    def is_contiguous(self):
+        """True if the spike trains fill the data array without gaps."""
+        return len(self) == 0 or (self.starts[0] == 0 and self.stops[-1] == len(self.data)
+                                  and np.all(self.starts[1:] == self.stops[:-1]))
+
+    def concatenated(self, seconds=True):
+        """
+        All spike trains concatenated, which is a view into the data if possible.
+        :param seconds: convert sample indices into s
+        :return: times: all spike times
+                 offsets: such that the spike train of the i-th neuron is times[offsets[i]:offsets[i+1]]
+        """
+        offsets = np.hstack((0, np.cumsum(self.counts())))
+        if self.is_contiguous():
+            data = self.data
+        else:
+            data = np.hstack([self.data[start:stop] for start, stop in zip(self.starts, self.stops)]) \
+                if len(self) > 0 else self.data[:0]
+        return (self.to_seconds(data) if seconds else data), offsets
+
+    def window(self, begin, end):
+        """
+        Spikes within the time window [begin, end) as views into the same data, using a binary search on each train.
+        :param begin, end: time window in s
+        :return: SpikeTrains
+        """
+        if self.sampling_rate is not None: begin, end = begin * self.sampling_rate, end * self.sampling_rate
+        starts, stops = np.empty_like(self.starts), np.empty_like(self.stops)
+        for i, (start, stop) in enumerate(zip(self.starts, self.stops)):
+            starts[i], stops[i] = start + np.searchsorted(self.data[start:stop], (begin, end), side='left')
+        return SpikeTrains(self.data, starts, stops, self.neurons, sampling_rate=self.sampling_rate)
+
+    def interval(self):
+        """First and last spike time in s."""
+        counts = self.counts()
+        nonempty = counts > 0
+        first = self.data[self.starts[nonempty]]
+        last = self.data[self.stops[nonempty] - 1]
+        return self.to_seconds(first.min()), self.to_seconds(last.max())
+
+    def arrays(self, prefix=''):
+        """Compact arrays representing the spike trains, see from_arrays."""
+        data, offsets = self.concatenated(seconds=False)
+        arrays = {prefix + 'data': data, prefix + 'offsets': offsets, prefix + 'neurons': self.neurons}
+        if self.sampling_rate is not None: arrays[prefix + 'sampling_rate'] = np.array(self.sampling_rate)
+        return arrays
+
+    def save(self, filename):
+        """Save spike trains as three datasets (data, offsets and neurons) into a HDF5 file."""
+        arrays = self.arrays()
+        with h5py.File(filename, 'w') as h5file:
+            for key in ('data', 'offsets', 'neurons'):
+                h5file[key] = arrays[key]
+            if self.sampling_rate is not None:
+                h5file.attrs['sampling_rate'] = self.sampling_rate
+
+    @classmethod
+    def load(cls, filename):
+        """Load spike trains saved by SpikeTrains.save."""
+        with h5py.File(filename, 'r') as h5file:
+            arrays = dict((key, h5file[key][()]) for key in ('data', 'offsets', 'neurons'))
+            if 'sampling_rate' in h5file.attrs:
+                arrays['sampling_rate'] = np.array(h5file.attrs['sampling_rate'])
+        return cls.from_arrays(arrays)
+
+    def save_npy(self, directory):
+        """Save spike trains as .npy files into a directory, which could be opened as memory maps by load_npy."""
+        for name, array in self.arrays().items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+
+    @classmethod
+    def load_npy(cls, directory, mmap_mode='r'):
+        """Load spike trains saved by save_npy, by default as read-only memory maps."""
+        names = ('data', 'offsets', 'neurons', 'sampling_rate')
+        arrays = dict((name, np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)) for name in names
+                      if os.path.isfile(os.path.join(directory, name + '.npy')))
+        return cls.from_arrays(arrays)
+
+
+def as_spiketrains(timeseries):
+    """Returns the time series as SpikeTrains, unless they are already."""
+    if isinstance(timeseries, SpikeTrains): return timeseries
+    if isinstance(timeseries, dict): return SpikeTrains.from_dict(timeseries)
+    return SpikeTrains.from_list(timeseries)
+
+
+def to_ticks(times, sampling_rate, dtype=np.int64):
+    """Returns the times (in s) as sample indices, unless they are already integers. The sample indices are int64
+    instead of dtype if they exceed its range, e.g. int32 for recordings longer than about 29.8 h at 20 kHz."""
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.integer): return times
+    ticks = np.round(times * sampling_rate)
+    if len(ticks) == 0: return ticks.astype(dtype)
+    if not np.all(np.isfinite(ticks)): raise ValueError('Times must be finite')
+    for integer_type in (dtype, np.int64):
+        limits = np.iinfo(integer_type)
+        if limits.min <= ticks.min() and ticks.max() <= limits.max: return ticks.astype(integer_type)
+    raise ValueError('Sample indices exceed the range of int64')
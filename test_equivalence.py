@@ -0,0 +1,173 @@
+"""
+Tests that the optimized kernels and engines give the same results as the straightforward implementations.
+Run with: python -m pytest test_equivalence.py
+"""
+
+import h5py
+import numpy as np
+
+from hana.function import timelag_by_for_loop, timelag_by_searchsorted, timelag_hist, all_timelag_hist, \
+    all_timelag_standardscore_array, SurrogateTimeseries, IncrementalStandardScore, binned_timelag_hists, \
+    analytic_timelag_null, adaptive_timelag_standardscore
+from hana.polychronous import filter, stream_pcgs
+from hana.recording import EventsFile, load_timeseries, partial_interval, partial_timeseries
+from hana.spiketrains import SpikeTrains
+from hana.timelags import TimelagStore
+
+
+def random_timeseries(neurons=4, n=500, duration=10.0, seed=0):
+    random_state = np.random.RandomState(seed)
+    return [np.sort(random_state.rand(n) * duration) for neuron in range(neurons)]
+
+
+def random_delays(neurons, density=0.5, seed=0):
+    random_state = np.random.RandomState(seed)
+    return {(pre, post): random_state.rand() * 5 for pre in range(neurons) for post in range(neurons)
+            if pre != post and random_state.rand() < density}
+
+
+def test_timelag_by_searchsorted():
+    single = np.array([0.5])
+    ties = np.array([0.1, 0.3, 0.3, 0.5, 0.7, 0.7])
+    spikes = np.sort(np.random.RandomState(0).rand(20))
+    for timeseries1, timeseries2 in ((spikes, np.array([])), (single, single), (single, spikes), (spikes, single),
+                                     (ties, ties), (ties, spikes), (spikes, ties)):
+        expected = timelag_by_for_loop(timeseries1, timeseries2)
+        assert np.array_equal(timelag_by_searchsorted(timeseries1, timeseries2), expected)
+    assert len(timelag_by_searchsorted(np.array([]), spikes)) == 0
+
+
+def test_all_timelag_hist():
+    timeseries = random_timeseries(neurons=3, n=1000, duration=1.0)
+    hist, bins = all_timelag_hist(timeseries)
+    for pre in range(3):
+        for post in range(3):
+            expected_hist = timelag_hist(timelag_by_for_loop(timeseries[pre], timeseries[post]))[0]
+            assert np.array_equal(hist[pre, post], expected_hist)
+
+
+def test_parallel_standardscore():
+    timeseries = random_timeseries()
+    surrogates = SurrogateTimeseries(dict(enumerate(timeseries)), n=5, seed=1)
+    timeseries_surrogates = [surrogates[neuron] for neuron in range(len(timeseries))]
+    pairs = [(0, 1), (2, 1), (3, 0), (1, 1)]
+    for pairs in (None, pairs):
+        serial = all_timelag_standardscore_array(timeseries, timeseries_surrogates, pairs=pairs)
+        parallel = all_timelag_standardscore_array(timeseries, timeseries_surrogates, pairs=pairs, workers=2)
+        for expected, result in zip(serial, parallel):
+            assert np.array_equal(expected, result, equal_nan=True)
+
+
+def test_parallel_filter():
+    timeseries = dict(enumerate(random_timeseries(neurons=6, n=2000)))
+    delays = random_delays(6)
+    expected = filter(timeseries, delays, synaptic_jitter=0.0005)
+    assert len(expected) > 0
+    assert np.array_equal(filter(timeseries, delays, synaptic_jitter=0.0005, workers=2), expected)
+
+
+def test_sweep_filter():
+    timeseries = dict(enumerate(random_timeseries(neurons=6, n=2000)))
+    delays = random_delays(6)
+    expected = filter(timeseries, delays, synaptic_jitter=0.0005)
+    assert np.array_equal(filter(timeseries, delays, synaptic_jitter=0.0005, matcher='sweep'), expected)
+
+
+def test_incremental_standardscore():
+    timeseries = random_timeseries(n=1000)
+    accumulator = IncrementalStandardScore(range(len(timeseries)), n=2)
+    for begin in range(10):
+        accumulator.add(dict((neuron, train[(train >= begin) & (train < begin + 1)])
+                             for neuron, train in enumerate(timeseries)), end=begin + 1)
+    _, _, timeseries_hist, _, _ = accumulator.standardscore_array()
+    assert np.array_equal(timeseries_hist, all_timelag_hist(timeseries)[0])
+
+
+def test_timelag_store():
+    timeseries = dict(enumerate(random_timeseries()))
+    surrogates = SurrogateTimeseries(timeseries, n=5, seed=1)
+    pairs = [(0, 1), (2, 1), (3, 0), (1, 1)]
+    store = TimelagStore.from_timeseries(timeseries, surrogates, pairs=pairs)
+    expected = all_timelag_standardscore_array([timeseries[neuron] for neuron in range(len(timeseries))],
+                                               [surrogates[neuron] for neuron in range(len(timeseries))], pairs=pairs)
+    for expected_values, values in zip(expected, store.standardscore()):
+        assert np.allclose(expected_values, values, equal_nan=True)
+
+
+def test_sweep_filter_silent_trains():
+    timeseries = dict(enumerate(random_timeseries(neurons=6, n=200)))
+    timeseries[2] = np.zeros(0)  # silent neuron
+    timeseries[4] = timeseries[4][timeseries[4] > 8]  # silent during most of the recording
+    delays = random_delays(6, density=0.8)
+    for workers in (1, 3):
+        expected = filter(timeseries, delays, synaptic_jitter=0.0005, workers=workers)
+        assert np.array_equal(filter(timeseries, delays, synaptic_jitter=0.0005, workers=workers, matcher='sweep'),
+                              expected)
+    assert len(filter({0: np.zeros(0), 1: np.arange(5.)}, {(0, 1): 1.0}, matcher='sweep')) == 0
+
+
+def test_binned_timelag_hists_self_pairs():
+    timeseries = random_timeseries(neurons=2, n=3000, duration=60.0)
+    hist, bins = binned_timelag_hists(timeseries, timeseries)
+    event_hist, _ = all_timelag_hist(timeseries)
+    zero_bin = np.searchsorted(bins, 0)
+    for neuron in range(len(timeseries)):  # no coincidences of the events with themselves
+        assert abs(hist[neuron, neuron, zero_bin] - event_hist[neuron, neuron, zero_bin]) <= 5
+    surrogates = SurrogateTimeseries(dict(enumerate(timeseries)), n=10, seed=1)
+    _, std_score, _, _, _ = all_timelag_standardscore_array(
+        timeseries, [surrogates[neuron] for neuron in range(len(timeseries))], backend='fft')
+    assert np.nanmax(std_score[range(2), range(2)]) < 5  # no self-connections
+
+
+def test_analytic_timelag_null():
+    # the analytic null model approximates the surrogates for sparse Poisson spike trains only
+    timeseries = random_timeseries(n=3000, duration=600.0)
+    surrogates = SurrogateTimeseries(dict(enumerate(timeseries)), n=100, seed=1)
+    _, _, _, surrogates_mean, surrogates_std = all_timelag_standardscore_array(
+        timeseries, [surrogates[neuron] for neuron in range(len(timeseries))])
+    mean, std = analytic_timelag_null(timeseries)
+    cross = ~np.eye(len(timeseries), dtype=bool)
+    assert abs(mean[cross].sum() / surrogates_mean[cross].sum() - 1) < 0.05
+    assert 0.9 < np.median(std[cross] / surrogates_std[cross]) < 1.25
+
+
+def test_ticks_of_long_recordings():
+    timeseries = {0: np.array([0, 30 * 3600.0]), 1: np.array([1.5, 2.5])}  # longer than int32 sample indices at 20 kHz
+    trains = SpikeTrains.from_dict(timeseries, sampling_rate=20000)
+    assert trains.data.dtype == np.int64
+    for neuron in timeseries:
+        assert np.array_equal(trains[neuron], timeseries[neuron])
+    assert SpikeTrains.from_dict({1: timeseries[1]}, sampling_rate=20000).data.dtype == np.int32
+
+
+def test_adaptive_standardscore_without_finite_scores():
+    timeseries = dict(enumerate(random_timeseries(neurons=3, n=5, duration=1000.0)))
+    surrogates = SurrogateTimeseries(timeseries, n=20, seed=1)
+    _, std_score_dict, _, n_used_dict = adaptive_timelag_standardscore(timeseries, surrogates)
+    assert len(std_score_dict) == 9
+    assert all(n_used == 20 for n_used in n_used_dict.values())  # never decided, all surrogates used
+
+
+def test_stream_pcgs_without_events(tmp_path):
+    filename = str(tmp_path / 'events.h5')
+    with h5py.File(filename, 'w') as h5file:
+        for neuron in range(3): h5file.create_dataset(str(neuron), data=np.zeros(0))
+    groups = []
+    with EventsFile(filename) as events:
+        assert stream_pcgs(events, {(0, 1): 1.0, (1, 2): 1.0}, lambda *group: groups.append(group)) == 0
+    assert stream_pcgs({0: np.zeros(0), 1: np.zeros(0)}, {(0, 1): 1.0}, groups.append) == 0
+    assert len(groups) == 0
+
+
+def test_partial_timeseries_from_events_file(tmp_path):
+    filename = str(tmp_path / 'events.h5')
+    timeseries = dict(enumerate(random_timeseries()))
+    timeseries[4] = np.zeros(0)
+    with h5py.File(filename, 'w') as h5file:
+        for neuron in timeseries: h5file.create_dataset(str(neuron), data=timeseries[neuron])
+    expected = partial_timeseries(load_timeseries(filename), interval=0.1)
+    with EventsFile(filename) as events:
+        partial = events.timeseries(*partial_interval(events, interval=0.1))
+    assert sorted(partial) == sorted(expected)
+    for neuron in expected:
+        assert np.array_equal(partial[neuron], expected[neuron])
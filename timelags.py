@@ -0,0 +1,143 @@
+"""
+Store of the raw time lags for parameter sweeps.
+
+The time lags from presynaptic events to the nearest preceding and succeeding postsynaptic events (see
+function.nearest_timelags) are kept within a maximal window for each pair, for the original and each surrogate
+postsynaptic time series. The time lags of each such segment are sorted float32 values, and all segments are stored in
+one array, such that the time lags of segment i are lags[offsets[i]:offsets[i+1]]. Histograms, standard scores and
+peaks are then computed for any bins within that window without looking up the spike trains again.
+"""
+
+import h5py
+import numpy as np
+
+from hana.function import concatenated_timeseries, nearest_timelags, timelag_bins, labeled_timelag_hist, \
+    standardscore_from_sums, all_peaks
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TimelagStore(object):
+    """
+    Time lags for neuron pairs, segment pair * (n + 1) contains the time lags for the original postsynaptic time series
+    and segment pair * (n + 1) + k for its k-th surrogate (k = 1..n).
+    """
+
+    def __init__(self, lags, offsets, pairs, n, max_timelag):
+        """
+        :param lags: all time lags (in s), sorted within each segment
+        :param offsets: index range of each segment in lags
+        :param pairs: array of (pre, post) neurons
+        :param n: number of surrogates
+        :param max_timelag: time lags within -max_timelag..max_timelag are stored
+        """
+        self.lags = lags
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.pairs = np.asarray(pairs).reshape(-1, 2)
+        self.n = n
+        self.max_timelag = max_timelag
+
+    @classmethod
+    def from_timeseries(cls, timeseries, timeseries_surrogates, max_timelag=0.005, pairs=None):
+        """
+        Collect the time lags for neuron pairs.
+        :param timeseries: dictionary (or SpikeTrains) of time series indexed by neuron
+        :param timeseries_surrogates: dictionary of lists of surrogate time series (or SurrogateTimeseries) indexed by
+        neuron
+        :param max_timelag: maximal absolute time lag (in s)
+        :param pairs: (optional) neuron pairs, default: all pairs
+        :return: TimelagStore
+        """
+        if pairs is None: pairs = [(pre, post) for post in timeseries for pre in timeseries]
+        pairs = list(pairs)
+        n = min(len(timeseries_surrogates[neuron]) for neuron in timeseries) if len(timeseries) > 0 else 0
+        rows_by_post = dict()
+        for i, (_, post) in enumerate(pairs):
+            rows_by_post.setdefault(post, []).append(i)
+        segments, lags = [], []
+        for post, rows in rows_by_post.items():
+            rows = np.array(rows, dtype=np.int64)
+            times, labels = concatenated_timeseries([timeseries[pairs[i][0]] for i in rows])
+            targets = [timeseries[post]] + [timeseries_surrogates[post][k] for k in range(n)]
+            for k, target in enumerate(targets):
+                time_lags, index = nearest_timelags(times, target)
+                keep = np.abs(time_lags) <= max_timelag
+                segments.append(rows[labels[index[keep]]] * (n + 1) + k)
+                lags.append(time_lags[keep].astype(np.float32))
+        segments = np.hstack(segments) if len(segments) > 0 else np.zeros(0, dtype=np.int64)
+        lags = np.hstack(lags) if len(lags) > 0 else np.zeros(0, dtype=np.float32)
+        order = np.lexsort((lags, segments))
+        counts = np.bincount(segments, minlength=len(pairs) * (n + 1))
+        logging.info('Stored %d time lags for %d pairs and %d surrogates' % (len(lags), len(pairs), n))
+        return cls(lags[order], np.hstack((0, np.cumsum(counts))), pairs, n, max_timelag)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def segment(self, pair_index, k=0):
+        """Sorted time lags for the pair (index into pairs) and the original (k=0) or k-th surrogate time series."""
+        i = pair_index * (self.n + 1) + k
+        return self.lags[self.offsets[i]:self.offsets[i + 1]]
+
+    def hist(self, min_timelag=-0.005, max_timelag=0.005, bin_n=100):
+        """
+        Count histograms of the time lags, same as function.timelag_hist but for all pairs and surrogates at once. The
+        time lags are float32, therefore counts could differ from histograms of the exact time lags by time lags
+        within float32 resolution of a bin edge.
+        :return: counts: indexed by (pair, k, bin), with k=0 for the original and k=1..n for the surrogates
+                 bins: bin edges
+        """
+        if min_timelag < -self.max_timelag or max_timelag > self.max_timelag:
+            raise ValueError('Time lags stored within +/-%g s only' % self.max_timelag)
+        bins = timelag_bins(min_timelag, max_timelag, bin_n)
+        segment_n = len(self.offsets) - 1
+        segments = np.repeat(np.arange(segment_n), np.diff(self.offsets))
+        counts = labeled_timelag_hist(self.lags, segments, segment_n, bins)
+        return counts.reshape(len(self.pairs), self.n + 1, bin_n), bins
+
+    def standardscore(self, min_timelag=-0.005, max_timelag=0.005, bin_n=100):
+        """
+        Standard scores for all pairs, see function.all_timelag_standardscore_array.
+        :return: timelags: midpoints of bins in ms
+                 std_score, timeseries_hist, surrogates_mean, surrogates_std: arrays indexed by (pair, bin)
+        """
+        counts, bins = self.hist(min_timelag=min_timelag, max_timelag=max_timelag, bin_n=bin_n)
+        timeseries_hist = counts[:, 0]
+        surrogates_hist = counts[:, 1:]
+        timelags = (bins[:-1] + bins[1:])/2 * 1000  # ms
+        std_score, surrogates_mean, surrogates_std = standardscore_from_sums(
+            timeseries_hist, surrogates_hist.sum(1), (surrogates_hist ** 2).sum(1), self.n)
+        return timelags, std_score, timeseries_hist, surrogates_mean, surrogates_std
+
+    def standardscores(self, min_timelag=-0.005, max_timelag=0.005, bin_n=100):
+        """
+        Standard scores indexed by neuron pairs, see function.all_timelag_standardscore.
+        :return: timelags, std_score_dict, timeseries_hist_dict
+        """
+        timelags, std_score, timeseries_hist, _, _ = self.standardscore(min_timelag=min_timelag,
+                                                                        max_timelag=max_timelag, bin_n=bin_n)
+        pairs = [tuple(pair) for pair in self.pairs.tolist()]
+        return timelags, dict(zip(pairs, std_score)), dict(zip(pairs, timeseries_hist))
+
+    def peaks(self, min_timelag=-0.005, max_timelag=0.005, bin_n=100, **kwargs):
+        """Peaks of the standard scores for these bins, see function.all_peaks for the other parameters."""
+        timelags, std_score_dict, _ = self.standardscores(min_timelag=min_timelag, max_timelag=max_timelag,
+                                                          bin_n=bin_n)
+        return all_peaks(timelags, std_score_dict, **kwargs)
+
+    def save(self, filename):
+        """Save time lags, offsets and pairs as datasets into a HDF5 file."""
+        with h5py.File(filename, 'w') as h5file:
+            h5file['lags'] = self.lags
+            h5file['offsets'] = self.offsets
+            h5file['pairs'] = self.pairs
+            h5file.attrs['n'] = self.n
+            h5file.attrs['max_timelag'] = self.max_timelag
+
+    @classmethod
+    def load(cls, filename):
+        """Load time lags saved by TimelagStore.save."""
+        with h5py.File(filename, 'r') as h5file:
+            return cls(h5file['lags'][()], h5file['offsets'][()], h5file['pairs'][()], int(h5file.attrs['n']),
+                       float(h5file.attrs['max_timelag']))